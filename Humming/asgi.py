@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Humming.settings')
 
 application = get_asgi_application()
+
+# Load the song catalog (and optionally the audio stack) before the first request
+from Humming.views import warm_up  # noqa: E402
+warm_up()
@@ -83,5 +83,47 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # Song database path
 SONG_DATABASE_PATH = BASE_DIR / 'songs_database.json'
 
+# Content-addressed cache of decoded audio and extracted features per song
+FEATURE_CACHE_DIR = BASE_DIR / 'cache' / 'features'
+# After each full rebuild, entries it did not use are dropped and the least
+# recently used ones are evicted beyond this size
+FEATURE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Limits for user audio; larger or longer uploads are rejected before decoding
+AUDIO_UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+AUDIO_UPLOAD_MAX_SECONDS = 60
+
+# User uploads are saved here, apart from the sample recordings in media/uploads;
+# files in it older than this (or beyond the size cap) are pruned
+UPLOAD_DIR = MEDIA_ROOT / 'uploads' / 'incoming'
+UPLOAD_RETENTION_SECONDS = 24 * 60 * 60
+UPLOAD_RETENTION_MAX_BYTES = 500 * 1024 * 1024
+
+# Catalogs with at least this many songs are pre-filtered with the melody
+# ANN index; only the nearest MELODY_INDEX_CANDIDATES songs are scored exactly
+MELODY_INDEX_MIN_SONGS = 1000
+MELODY_INDEX_CANDIDATES = 50
+
+# Import librosa/numba and compile JIT code at startup instead of on the first
+# audio request; enable for pre-fork servers (gunicorn --preload)
+PRELOAD_AUDIO_STACK = False
+
+# Identical audio queries in flight at once share one computation within a
+# process; set a directory to also coalesce across worker processes
+DEDUP_LOCK_DIR = None  # e.g. BASE_DIR / 'cache' / 'inflight'
+
+# Matching runs in stages (screen, correlation, alignment) within a time
+# budget; the budget shrinks towards the minimum while the p99 of the
+# matching stage (not decoding or feature extraction) is above target and
+# grows back towards the maximum once it recovers
+MATCH_TARGET_P99_MS = 250
+MATCH_BUDGET_MAX_MS = 500
+MATCH_BUDGET_MIN_MS = 20
+
+# Worker processes /match/batch/ keeps for audio queries (shared by concurrent
+# batches); batches of pre-extracted features are scored in the request's own
+# process
+BATCH_MATCH_WORKERS = 2
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.backends.BigAutoField'
\ No newline at end of file
@@ -10,7 +10,9 @@ urlpatterns = [
     path('upload/', views.upload_audio, name='upload_audio'),
     path('record/', views.record_audio, name='record_audio'),
     path('match/', views.match_song, name='match_song'),
+    path('match/batch/', views.match_batch, name='match_batch'),
     path('get_songs/', views.get_songs, name='get_songs'),
+    path('stats/', views.stats, name='stats'),
     path('play_song/<path:song_path>/', views.play_song, name='play_song'),
 ]
 
@@ -1,67 +1,136 @@
 from django.shortcuts import render
-from django.http import JsonResponse, FileResponse
+from django.http import HttpResponse, JsonResponse, FileResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+from django.views.decorators.http import condition
 from django.views.decorators.csrf import csrf_exempt
 from django.core.files.storage import FileSystemStorage
+import functools
 import json
 import os
+import time
 import wave
 import struct
 import io
 from utils.qtune_processor import QTuneProcessor
+from utils.lazy import import_times, is_available, report_import_times
+from utils.catalog import SongCatalog, SongIndex
+from utils.feature_cache import FeatureCache
+from utils.batch import WorkerPool, iter_batch_matches
+from utils.singleflight import SingleFlight, payload_key
+from utils.budget import AdaptiveBudget
+from utils.uploads import (
+    AudioUploadHandler, SNIFF_BYTES, UploadRejected, check_audio_header,
+    read_limited_body, schedule_upload_cleanup
+)
 from django.conf import settings
 
 processor = QTuneProcessor()
+feature_cache = FeatureCache(settings.FEATURE_CACHE_DIR)
+inflight = SingleFlight(lock_dir=settings.DEDUP_LOCK_DIR)
+# brotli is optional; without it song listings are gzip-compressed only
+HAS_BROTLI = is_available('brotli')
+query_budget = AdaptiveBudget(
+    target_p99=settings.MATCH_TARGET_P99_MS / 1000,
+    max_budget=settings.MATCH_BUDGET_MAX_MS / 1000,
+    min_budget=settings.MATCH_BUDGET_MIN_MS / 1000
+)
+# Audio batches share these worker processes, started on the first one
+batch_pool = WorkerPool(settings.BATCH_MATCH_WORKERS)
 
 def home(request):
     """Render the main page."""
     return render(request, 'index.html')
 
+def find_matches(features, database):
+    """Rank songs for a query within the current adaptive budget.
+    
+    Large catalogs are pre-filtered with the melody index. Returns the matches
+    and a description of the matching stage that produced the ranking. The
+    time spent here is what the adaptive budget controls, so it is recorded.
+    """
+    prepared = catalog.prepared(database)
+    start = time.perf_counter()
+    try:
+        return processor.find_best_matches(
+            features, database, budget=query_budget.budget, with_info=True, prepared=prepared,
+            index=catalog.melody_index(), candidates=settings.MELODY_INDEX_CANDIDATES
+        )
+    finally:
+        query_budget.record(time.perf_counter() - start)
+
+def _guard_uploads(request):
+    """Enforce size/format limits on files while the request body streams in."""
+    request.upload_handlers.insert(0, AudioUploadHandler(
+        request, settings.AUDIO_UPLOAD_MAX_BYTES, settings.AUDIO_UPLOAD_MAX_SECONDS
+    ))
+
+def _rejected(error):
+    """JSON error response for an UploadRejected, with its HTTP status."""
+    return JsonResponse({'success': False, 'error': str(error)}, status=error.status)
+
 @csrf_exempt
 def upload_audio(request):
     """Handle audio file upload."""
     if request.method == 'POST':
         try:
+            _guard_uploads(request)
+            request.FILES  # parse the body through the guard
+            if request.upload_rejection:
+                return _rejected(request.upload_rejection)
+            
             if 'audio' in request.FILES:
                 audio_file = request.FILES['audio']
                 
                 # Save uploaded file
-                fs = FileSystemStorage(location=settings.MEDIA_ROOT / 'uploads')
+                upload_dir = settings.UPLOAD_DIR
+                fs = FileSystemStorage(location=upload_dir)
                 filename = fs.save(audio_file.name, audio_file)
                 file_path = fs.path(filename)
+                schedule_upload_cleanup(
+                    upload_dir, settings.UPLOAD_RETENTION_SECONDS, settings.UPLOAD_RETENTION_MAX_BYTES
+                )
                 
                 # Process the audio
                 with open(file_path, 'rb') as f:
                     audio_data = f.read()
                 
-                features = processor.process_user_audio(audio_data)
-                
-                if features:
-                    # Find matches
-                    database = load_song_database()
+                def process():
+                    features = processor.process_user_audio(
+                        audio_data, max_duration=settings.AUDIO_UPLOAD_MAX_SECONDS
+                    )
                     
-                    if not database:
-                        return JsonResponse({
+                    if features:
+                        # Find matches
+                        database = load_song_database()
+                        
+                        if not database:
+                            return {
+                                'success': False,
+                                'error': 'No songs in database. Please add songs to media/songs/ directory first.'
+                            }
+                        
+                        matches, ranking = find_matches(features, database)
+                        
+                        return {
+                            'success': True,
+                            'features': {
+                                'tempo': features.get('tempo', 0),
+                                'duration': features.get('duration', 0),
+                                'pitch_count': features.get('pitch_count', 0),
+                                'onset_count': features.get('onset_count', 0)
+                            },
+                            'matches': matches,
+                            'ranking': ranking
+                        }
+                    else:
+                        return {
                             'success': False,
-                            'error': 'No songs in database. Please add songs to media/songs/ directory first.'
-                        })
-                    
-                    matches = processor.find_best_matches(features, database)
-                    
-                    return JsonResponse({
-                        'success': True,
-                        'features': {
-                            'tempo': features.get('tempo', 0),
-                            'duration': features.get('duration', 0),
-                            'pitch_count': features.get('pitch_count', 0),
-                            'onset_count': features.get('onset_count', 0)
-                        },
-                        'matches': matches
-                    })
-                else:
-                    return JsonResponse({
-                        'success': False,
-                        'error': 'Could not extract features from audio.'
-                    })
+                            'error': 'Could not extract features from audio.'
+                        }
+                
+                # Identical uploads in flight at the same time share one computation
+                return JsonResponse(inflight.do(payload_key('upload', audio_data), process))
             else:
                 return JsonResponse({
                     'success': False,
@@ -162,62 +231,79 @@ def record_audio(request):
         try:
             audio_data = None
             
+            _guard_uploads(request)
+            
             # Handle different ways audio data can be sent
             if 'audio' in request.FILES:
                 # FormData submission
                 audio_file = request.FILES['audio']
                 audio_data = audio_file.read()
-            elif request.body:
-                # Raw body submission
-                audio_data = request.body
+            elif request.upload_rejection is None and request.content_type != 'multipart/form-data':
+                # Raw body submission, read in bounded chunks
+                try:
+                    audio_data = read_limited_body(request, settings.AUDIO_UPLOAD_MAX_BYTES)
+                    if audio_data:
+                        check_audio_header(audio_data[:SNIFF_BYTES], settings.AUDIO_UPLOAD_MAX_SECONDS)
+                except UploadRejected as e:
+                    return _rejected(e)
+            
+            if request.upload_rejection:
+                return _rejected(request.upload_rejection)
             
             if not audio_data:
                 return JsonResponse({'success': False, 'error': 'No audio data received'})
             
-            # Check if it's WebM format and convert to WAV
-            if isinstance(audio_data, bytes):
-                # Check for WebM/Opus signature
-                if audio_data[:4] == b'\x1aE\xdf\xa3' or b'webm' in audio_data[:100].lower():
-                    print("Converting WebM to WAV...")
-                    wav_data = webm_to_wav(audio_data)
-                    if wav_data:
-                        audio_data = wav_data
-                    else:
-                        return JsonResponse({
-                            'success': False,
-                            'error': 'Failed to convert audio format. Please install ffmpeg: sudo apt-get install ffmpeg'
-                        })
-            
-            # Process the audio
-            features = processor.process_user_audio(audio_data)
-            
-            if features:
-                # Find matches
-                database = load_song_database()
+            def process(audio_data=audio_data):
+                # Check if it's WebM format and convert to WAV
+                if isinstance(audio_data, bytes):
+                    # Check for WebM/Opus signature
+                    if audio_data[:4] == b'\x1aE\xdf\xa3' or b'webm' in audio_data[:100].lower():
+                        print("Converting WebM to WAV...")
+                        wav_data = webm_to_wav(audio_data)
+                        if wav_data:
+                            audio_data = wav_data
+                        else:
+                            return {
+                                'success': False,
+                                'error': 'Failed to convert audio format. Please install ffmpeg: sudo apt-get install ffmpeg'
+                            }
                 
-                if not database:
-                    return JsonResponse({
-                        'success': False,
-                        'error': 'No songs in database. Please add songs to media/songs/ directory.'
-                    })
-                
-                matches = processor.find_best_matches(features, database)
+                # Process the audio
+                features = processor.process_user_audio(
+                    audio_data, max_duration=settings.AUDIO_UPLOAD_MAX_SECONDS
+                )
                 
-                return JsonResponse({
-                    'success': True,
-                    'features': {
-                        'tempo': features.get('tempo', 0),
-                        'duration': features.get('duration', 0),
-                        'pitch_count': features.get('pitch_count', 0),
-                        'onset_count': features.get('onset_count', 0)
-                    },
-                    'matches': matches
-                })
-            else:
-                return JsonResponse({
-                    'success': False,
-                    'error': 'Could not extract features from audio. Please try a clearer recording.'
-                })
+                if features:
+                    # Find matches
+                    database = load_song_database()
+                    
+                    if not database:
+                        return {
+                            'success': False,
+                            'error': 'No songs in database. Please add songs to media/songs/ directory.'
+                        }
+                    
+                    matches, ranking = find_matches(features, database)
+                    
+                    return {
+                        'success': True,
+                        'features': {
+                            'tempo': features.get('tempo', 0),
+                            'duration': features.get('duration', 0),
+                            'pitch_count': features.get('pitch_count', 0),
+                            'onset_count': features.get('onset_count', 0)
+                        },
+                        'matches': matches,
+                        'ranking': ranking
+                    }
+                else:
+                    return {
+                        'success': False,
+                        'error': 'Could not extract features from audio. Please try a clearer recording.'
+                    }
+            
+            # Identical recordings in flight at the same time share one computation
+            return JsonResponse(inflight.do(payload_key('record', audio_data), process))
         
         except Exception as e:
             print(f"Error in record_audio: {e}")
@@ -240,11 +326,12 @@ def match_song(request):
             
             # Find matches
             database = load_song_database()
-            matches = processor.find_best_matches(user_features, database)
+            matches, ranking = find_matches(user_features, database)
             
             return JsonResponse({
                 'success': True,
-                'matches': matches
+                'matches': matches,
+                'ranking': ranking
             })
         
         except Exception as e:
@@ -255,20 +342,172 @@ def match_song(request):
     
     return JsonResponse({'success': False, 'error': 'Invalid request'})
 
-def get_songs(request):
-    """Get list of available songs."""
-    database = load_song_database()
-    songs = []
+def _parse_batch_queries(request):
+    """Read batch queries from multipart audio files, JSON lines or a JSON body."""
+    if request.content_type == 'multipart/form-data':
+        queries = [
+            {'id': audio_file.name, 'audio': audio_file.read()}
+            for audio_file in request.FILES.getlist('audio')
+        ]
+        return queries, int(request.POST.get('top_n', 3))
+    
+    if request.content_type == 'application/x-ndjson':
+        items = [json.loads(line) for line in request.body.splitlines() if line.strip()]
+        top_n = int(request.GET.get('top_n', 3))
+    else:
+        data = json.loads(request.body)
+        if isinstance(data, dict):
+            items = data.get('queries', [])
+            top_n = int(data.get('top_n', 3))
+        else:
+            items = data
+            top_n = int(request.GET.get('top_n', 3))
     
-    for song in database:
-        songs.append({
-            'name': song.get('name'),
-            'path': song.get('path'),
-            'tempo': song.get('tempo'),
-            'pitch_count': song.get('pitch_count', 0)
+    queries = []
+    for i, item in enumerate(items):
+        # Only pre-extracted features are accepted as JSON; never read server-side paths
+        features = item.get('features', item) if isinstance(item, dict) else {}
+        queries.append({'id': item.get('id', i) if isinstance(item, dict) else i, 'features': features})
+    return queries, top_n
+
+@csrf_exempt
+def match_batch(request):
+    """Match many feature sets or audio files and stream results as JSON lines."""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request method'})
+    
+    try:
+        _guard_uploads(request)
+        queries, top_n = _parse_batch_queries(request)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': f'Invalid batch request: {str(e)}'})
+    
+    if request.upload_rejection:
+        return _rejected(request.upload_rejection)
+    
+    if not queries:
+        return JsonResponse({'success': False, 'error': 'No queries provided'})
+    
+    database = load_song_database()
+    if not database:
+        return JsonResponse({
+            'success': False,
+            'error': 'No songs in database. Please add songs to media/songs/ directory.'
         })
     
-    return JsonResponse({'songs': songs})
+    # Feature-only scoring is cheap; only audio decoding is worth extra processes
+    if all('features' in query for query in queries):
+        pool = None
+    else:
+        pool = batch_pool
+    results = iter_batch_matches(
+        queries, database, top_n=top_n, workers=1, pool=pool,
+        prepared=catalog.prepared(database), max_duration=settings.AUDIO_UPLOAD_MAX_SECONDS,
+        index=catalog.melody_index(), candidates=settings.MELODY_INDEX_CANDIDATES
+    )
+    return StreamingHttpResponse(
+        (json.dumps(result) + '\n' for result in results),
+        content_type='application/x-ndjson'
+    )
+
+SONG_LIST_DEFAULT_FIELDS = ('name', 'path', 'tempo', 'pitch_count')
+SONG_LIST_MAX_LIMIT = 500
+
+def _songs_etag(request):
+    """ETag for get_songs: catalog version plus content coding, so unchanged catalogs answer 304."""
+    catalog.get()
+    if not catalog.version:
+        return None
+    return f"{catalog.version}-{_pick_encoding(request) or 'identity'}"
+
+@functools.lru_cache(maxsize=256)
+def _songs_body(version, prefix, offset, limit, fields, encoding):
+    """Serialize (and compress) one page of the song listing for a catalog version."""
+    rows, total = catalog.index().search(prefix, offset, limit)
+    next_offset = offset + len(rows)
+    body = json.dumps({
+        'songs': [{field: row[field] for field in fields} for row in rows],
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'next_offset': next_offset if next_offset < total else None
+    }).encode('utf-8')
+    
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(body)
+    if encoding == 'gzip':
+        return compress_string(body)
+    return body
+
+def _accepted_encodings(header):
+    """Parse an Accept-Encoding header into {coding: q-value}."""
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+def _pick_encoding(request):
+    """Choose br or gzip by the client's q-values (br wins ties), or None for identity."""
+    accepted = _accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    candidates = ['br', 'gzip'] if HAS_BROTLI else ['gzip']
+    
+    best, best_q = None, 0.0
+    for coding in candidates:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+@condition(etag_func=_songs_etag)
+def get_songs(request):
+    """Get a page of available songs, optionally filtered by name prefix.
+    
+    Query parameters: ``q`` (name prefix), ``offset``, ``limit`` and
+    ``fields`` (comma-separated subset of the listing fields).
+    """
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = min(SONG_LIST_MAX_LIMIT, max(1, int(request.GET.get('limit', 50))))
+    except ValueError:
+        return JsonResponse({'error': 'offset and limit must be integers'}, status=400)
+    
+    fields = SONG_LIST_DEFAULT_FIELDS
+    if request.GET.get('fields'):
+        fields = tuple(f.strip() for f in request.GET['fields'].split(',') if f.strip())
+        unknown = [f for f in fields if f not in SongIndex.LISTING_FIELDS]
+        if unknown:
+            return JsonResponse({'error': f"Unknown fields: {', '.join(unknown)}"}, status=400)
+    
+    encoding = _pick_encoding(request)
+    body = _songs_body(catalog.version, request.GET.get('q', ''), offset, limit, fields, encoding)
+    
+    response = HttpResponse(body, content_type='application/json')
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def stats(request):
+    """Report query coalescing counters, the adaptive matching budget and deferred import times."""
+    return JsonResponse({
+        'dedup': dict(inflight.stats),
+        'budget': query_budget.stats(),
+        'import_ms': {name: round(seconds * 1000, 1) for name, seconds in import_times.items()}
+    })
 
 def play_song(request, song_path):
     """Serve song file for playback."""
@@ -298,28 +537,14 @@ def play_song(request, song_path):
         return JsonResponse({'error': str(e)}, status=500)
 
 def load_song_database():
-    """Load song database from JSON file."""
-    db_path = settings.SONG_DATABASE_PATH
-    
-    if not os.path.exists(db_path):
-        # Create initial database
-        return create_song_database()
-    
-    else:
-        # Load existing database
-        try:
-            with open(db_path, 'r') as f:
-                database = json.load(f)
-                # Ensure database is a list
-                if not isinstance(database, list):
-                    return create_song_database()
-                return database
-        except:
-            return create_song_database()
+    """Return the cached song database; never rebuilds it inside a request."""
+    return catalog.get()
 
-def create_song_database():
-    """Create song database by scanning songs directory."""
+def build_song_database():
+    """Scan the songs directory and extract features for every song."""
     database = []
+    # Margin for filesystems with coarse mtimes
+    started = time.time() - 2
     
     # Scan songs directory
     songs_dir = settings.MEDIA_ROOT / 'songs'
@@ -330,7 +555,7 @@ def create_song_database():
                 print(f"Processing {file.name}...")
                 
                 try:
-                    features = processor.process_audio_file(str(file))
+                    features = processor.process_audio_file(str(file), cache=feature_cache)
                     if features and features.get('relative_pitches'):
                         database.append({
                             'name': file.stem.replace('_', ' ').title(),
@@ -347,11 +572,39 @@ def create_song_database():
                 
                 except Exception as e:
                     print(f"  ✗ Error processing {file.name}: {e}")
+        
+        # Drop artifacts of removed songs and superseded stage versions
+        removed = feature_cache.prune(unused_since=started, max_bytes=settings.FEATURE_CACHE_MAX_BYTES)
+        if removed:
+            print(f"Pruned {removed} unused feature cache entries")
     
-    # Save database
-    db_path = settings.SONG_DATABASE_PATH
-    with open(db_path, 'w') as f:
-        json.dump(database, f, indent=2)
+    return database
+
+def create_song_database():
+    """Rebuild the song database and save it (waits for a running rebuild)."""
+    return catalog.rebuild(wait=True)
+
+catalog = SongCatalog(
+    settings.SONG_DATABASE_PATH, build_song_database,
+    ann_min_songs=settings.MELODY_INDEX_MIN_SONGS
+)
+
+def warm_up():
+    """Prepare this process before it serves requests (called from wsgi/asgi).
+    
+    Always loads the song catalog and the scorer kernels (numba, when
+    installed); with PRELOAD_AUDIO_STACK it also imports librosa and warms its
+    caches, which under a pre-fork server (gunicorn --preload) happens once in
+    the master instead of per worker. Deferred import times are printed here
+    and reported by /stats/.
+    """
+    catalog.warm_up()
     
-    print(f"Database created with {len(database)} songs")
-    return database
\ No newline at end of file
+    start = time.perf_counter()
+    if settings.PRELOAD_AUDIO_STACK:
+        processor.warm_up()
+        print(f"Audio stack preloaded in {time.perf_counter() - start:.1f}s")
+    else:
+        processor.warm_up_scorer()
+        print(f"Scorer ({processor.scorer.name}) ready in {time.perf_counter() - start:.1f}s")
+    report_import_times()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Score many queries against the song database in one run.
+Inputs are audio files and/or JSON-lines files whose lines hold either
+{"id": ..., "features": {...}}, {"id": ..., "audio_path": "..."} or a bare
+features dict. Results are written as JSON lines, one per query, in order.
+"""
+
+import argparse
+import json
+import os
+import sys
+import django
+
+# Setup Django
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Humming.settings')
+django.setup()
+
+from django.conf import settings
+from Humming.views import catalog
+from utils.batch import iter_batch_matches
+
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.m4a', '.flac']
+
+
+def read_queries(paths):
+    """Expand the command-line inputs into a list of query dicts."""
+    queries = []
+    for path in paths:
+        if os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS:
+            queries.append({'id': path, 'audio_path': path})
+            continue
+
+        with open(path, 'r') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                query_id = item.get('id', f"{path}:{line_no}")
+                if 'features' in item:
+                    queries.append({'id': query_id, 'features': item['features']})
+                elif 'audio_path' in item:
+                    queries.append({'id': query_id, 'audio_path': item['audio_path']})
+                else:
+                    queries.append({'id': query_id, 'features': item})
+    return queries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='audio files or .jsonl query files')
+    parser.add_argument('--top-n', type=int, default=3, help='matches to report per query')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('-o', '--output', help='write results here instead of stdout')
+    args = parser.parse_args()
+
+    queries = read_queries(args.inputs)
+    database = catalog.warm_up()
+    if not database:
+        sys.exit("No songs in database. Run init_database.py first.")
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        results = iter_batch_matches(
+            queries, database, top_n=args.top_n, workers=args.workers,
+            prepared=catalog.prepared(database),
+            index=catalog.melody_index(), candidates=settings.MELODY_INDEX_CANDIDATES
+        )
+        for result in results:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"Scored {len(queries)} queries against {len(database)} songs", file=sys.stderr)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+Check that the optional Numba scorer backend agrees with the NumPy one.
+Scores random interval sequences with both and exits non-zero on any mismatch.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from utils.lazy import is_available
+from utils.qtune_processor import NumbaScorer, NumpyScorer, compare_scorers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trials', type=int, default=300, help='random cases to score')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    if not is_available('numba'):
+        sys.exit("numba is not installed; only the NumPy backend is in use.")
+
+    mismatches = compare_scorers(NumpyScorer(), NumbaScorer(), trials=args.trials, seed=args.seed)
+    for kernel, a, b, expected, actual in mismatches[:20]:
+        print(f"{kernel}: numpy={expected} numba={actual}\n  a={a}\n  b={b}")
+
+    if mismatches:
+        sys.exit(f"{len(mismatches)} mismatches in {args.trials} cases")
+    print(f"NumPy and Numba backends agree on {args.trials} random cases")
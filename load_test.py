@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+"""
+Replay recorded traffic against HumSearch and report per-endpoint performance.
+Each line of the traffic file is a JSON request, e.g.
+  {"endpoint": "get_songs", "query": {"q": "a", "limit": 20}}
+  {"endpoint": "play_song", "song_path": "songs/Yours.mp3"}
+  {"endpoint": "match_song", "features": {"tempo": 120, "relative_pitches": [2, -1]}}
+  {"endpoint": "upload_audio", "audio": "media/uploads/Perfect.m4a"}
+  {"endpoint": "record_audio", "audio": "media/uploads/Yours.MP3"}
+Lines without a known "endpoint" are skipped. Without a traffic file (or with
+--synthetic N) a mix is generated from the song database and media/uploads.
+Replayed uploads are saved by the server like real ones, in UPLOAD_DIR
+(media/uploads/incoming), and pruned with them.
+
+Requests run in-process through Django's test client by default, or over HTTP
+with --url (an already running server) or --serve (start one: sync, threaded
+or asgi), so the same traffic can be compared across worker models.
+"""
+
+import argparse
+import json
+import mimetypes
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows: no peak-RSS reporting for in-process runs
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss():
+    """Peak RSS of this process so far in bytes (0 where unsupported)."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+ENDPOINTS = ['upload_audio', 'record_audio', 'match_song', 'get_songs', 'play_song']
+
+
+# ----------------------------------------------------------------------
+# Traffic
+# ----------------------------------------------------------------------
+def read_traffic(path):
+    """Load request specs from a JSON-lines file, skipping unknown lines."""
+    specs = []
+    skipped = 0
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                spec = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if isinstance(spec, dict) and spec.get('endpoint') in ENDPOINTS:
+                specs.append(spec)
+            else:
+                skipped += 1
+    if skipped:
+        print(f"Skipped {skipped} lines without a known endpoint in {path}", file=sys.stderr)
+    return specs
+
+
+def synthetic_traffic(count, seed=0):
+    """Build a request mix from the song database and the sample uploads."""
+    rng = random.Random(seed)
+    try:
+        with open(os.path.join(BASE_DIR, 'songs_database.json'), 'r') as f:
+            database = json.load(f)
+    except (OSError, ValueError):
+        database = []
+    playable = [
+        song['path'].replace('\\', '/') for song in database
+        if os.path.exists(os.path.join(BASE_DIR, 'media', song['path'].replace('\\', '/')))
+    ]
+    uploads_dir = os.path.join(BASE_DIR, 'media', 'uploads')
+    uploads = sorted(
+        os.path.join('media', 'uploads', name) for name in os.listdir(uploads_dir)
+        if os.path.isfile(os.path.join(uploads_dir, name))
+    ) if os.path.isdir(uploads_dir) else []
+
+    kinds = ['get_songs'] * 4 + ['play_song'] * 2 + ['match_song'] * 3
+    if uploads:
+        kinds += ['upload_audio', 'record_audio']
+
+    specs = []
+    for _ in range(count):
+        kind = rng.choice(kinds)
+        if kind == 'get_songs':
+            query = {'limit': rng.choice([10, 50])}
+            if database and rng.random() < 0.5:
+                query['q'] = rng.choice(database).get('name', '')[:2]
+            specs.append({'endpoint': kind, 'query': query})
+        elif kind == 'play_song' and playable:
+            specs.append({'endpoint': kind, 'song_path': rng.choice(playable)})
+        elif kind == 'match_song' and database:
+            song = rng.choice(database)
+            start = rng.randrange(max(1, len(song['relative_pitches']) - 40))
+            specs.append({'endpoint': kind, 'features': {
+                'tempo': song['tempo'],
+                'relative_pitches': song['relative_pitches'][start:start + 40]
+            }})
+        elif kind in ('upload_audio', 'record_audio'):
+            specs.append({'endpoint': kind, 'audio': rng.choice(uploads)})
+        else:
+            specs.append({'endpoint': 'get_songs', 'query': {}})
+    return specs
+
+
+def build_request(spec):
+    """Turn a spec into (method, path, body, content_type)."""
+    endpoint = spec['endpoint']
+    if endpoint == 'get_songs':
+        query = urllib.parse.urlencode(spec.get('query', {}))
+        return 'GET', '/get_songs/' + (f'?{query}' if query else ''), None, None
+    if endpoint == 'play_song':
+        return 'GET', '/play_song/' + urllib.parse.quote(spec['song_path']) + '/', None, None
+    if endpoint == 'match_song':
+        return 'POST', '/match/', json.dumps({'features': spec.get('features', {})}).encode('utf-8'), 'application/json'
+
+    audio_path = os.path.join(BASE_DIR, spec['audio'])
+    with open(audio_path, 'rb') as f:
+        audio = f.read()
+    if endpoint == 'record_audio' and not spec.get('multipart'):
+        content_type = mimetypes.guess_type(audio_path)[0] or 'application/octet-stream'
+        return 'POST', '/record/', audio, content_type
+
+    boundary = uuid.uuid4().hex
+    filename = os.path.basename(audio_path)
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="audio"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8') + audio + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    path = '/upload/' if endpoint == 'upload_audio' else '/record/'
+    return 'POST', path, body, f'multipart/form-data; boundary={boundary}'
+
+
+# ----------------------------------------------------------------------
+# Transports
+# ----------------------------------------------------------------------
+class InProcessTransport:
+    """Calls the views through Django's test client in this process."""
+
+    name = 'inprocess'
+
+    def __init__(self):
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Humming.settings')
+        sys.path.insert(0, BASE_DIR)
+        import django
+        django.setup()
+        from Humming.views import warm_up
+        warm_up()
+        self._local = threading.local()
+
+    def send(self, method, path, body, content_type):
+        from django.test import Client
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = Client(HTTP_HOST='localhost')
+        if method == 'GET':
+            response = client.get(path)
+        else:
+            response = client.generic(method, path, body, content_type=content_type)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response.status_code, content
+
+    def server_usage(self):
+        return None
+
+
+class HttpTransport:
+    """Sends real HTTP requests to a running server."""
+
+    name = 'http'
+
+    def __init__(self, url, pid=None):
+        self.url = url.rstrip('/')
+        self.pid = pid
+
+    def send(self, method, path, body, content_type):
+        request = urllib.request.Request(self.url + path, data=body, method=method)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def server_usage(self):
+        """(cpu_seconds, rss_bytes) of the server process, if we know its pid (Linux)."""
+        if self.pid is None:
+            return None
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            ticks = os.sysconf('SC_CLK_TCK')
+            cpu = (int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])) / ticks
+            with open(f'/proc/{self.pid}/statm') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            return cpu, rss
+        except (OSError, ValueError, IndexError):
+            return None
+
+
+SERVE_COMMANDS = {
+    'sync': [sys.executable, 'manage.py', 'runserver', '--noreload', '--nothreading'],
+    'threaded': [sys.executable, 'manage.py', 'runserver', '--noreload'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'Humming.asgi:application', '--port'],
+}
+
+
+def start_server(model):
+    """Start a local server for a worker model; return (process, url)."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    cmd = list(SERVE_COMMANDS[model])
+    cmd.append(str(port) if model == 'asgi' else f'127.0.0.1:{port}')
+    process = subprocess.Popen(cmd, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"Server for '{model}' exited during start-up: {' '.join(cmd)}")
+        try:
+            urllib.request.urlopen(url + '/get_songs/?limit=1', timeout=5).read()
+            return process, url
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    sys.exit(f"Server for '{model}' did not start within 120s")
+
+
+# ----------------------------------------------------------------------
+# Running and reporting
+# ----------------------------------------------------------------------
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run(transport, specs, concurrency, rate=None):
+    """Replay specs and return per-request records plus the wall time.
+
+    With ``rate`` the arrivals are open-loop (requests are released on a fixed
+    schedule and latency includes queueing); otherwise ``concurrency`` clients
+    send back to back.
+    """
+    records = []
+    lock = threading.Lock()
+    prepared = [(spec['endpoint'], build_request(spec)) for spec in specs]
+
+    def one(endpoint, request, scheduled):
+        # Open-loop latency is measured from when the request was due, not sent
+        start = scheduled if scheduled is not None else time.perf_counter()
+        cpu_start = time.thread_time()
+        server_before = transport.server_usage() if concurrency == 1 else None
+        peak_before = peak_rss() if concurrency == 1 else None
+        try:
+            status, content = transport.send(*request)
+            ok = status < 400
+            try:
+                app_error = json.loads(content).get('success') is False
+            except (ValueError, AttributeError, UnicodeDecodeError):
+                app_error = False
+        except Exception:
+            ok, app_error = False, False
+        latency = time.perf_counter() - start
+        server_after = transport.server_usage() if concurrency == 1 else None
+
+        record = {
+            'endpoint': endpoint,
+            'latency': latency,
+            'ok': ok,
+            'app_error': app_error,
+            'cpu': time.thread_time() - cpu_start,
+            # Memory growth is only attributable to a request when requests run one at a time:
+            # in-process, how far it raised the peak; for a server, the change in its RSS
+            'rss_growth': peak_rss() - peak_before if peak_before is not None else None,
+        }
+        if server_before and server_after:
+            record['cpu'] = server_after[0] - server_before[0]
+            record['rss_growth'] = server_after[1] - server_before[1]
+        with lock:
+            records.append(record)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, (endpoint, request) in enumerate(prepared):
+            scheduled = None
+            if rate:
+                scheduled = wall_start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(one, endpoint, request, scheduled)
+    return records, time.perf_counter() - wall_start
+
+
+def process_peak_rss(transport):
+    """Peak RSS of the process that served the requests, in bytes, or None if unknown."""
+    if isinstance(transport, HttpTransport):
+        if transport.pid is None:
+            return None
+        try:
+            with open(f'/proc/{transport.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+    return peak_rss() or None
+
+
+def summarize(records, wall_time):
+    summary = {}
+    for endpoint in sorted({r['endpoint'] for r in records}):
+        rows = [r for r in records if r['endpoint'] == endpoint]
+        latencies = [r['latency'] * 1000 for r in rows]
+        growth = [r['rss_growth'] for r in rows if r['rss_growth'] is not None]
+        summary[endpoint] = {
+            'requests': len(rows),
+            'throughput_rps': len(rows) / wall_time if wall_time else 0.0,
+            'error_rate': sum(not r['ok'] for r in rows) / len(rows),
+            'app_error_rate': sum(r['app_error'] for r in rows) / len(rows),
+            'p50_ms': percentile(latencies, 50),
+            'p90_ms': percentile(latencies, 90),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': max(latencies),
+            'cpu_ms_per_request': sum(r['cpu'] for r in rows) * 1000 / len(rows),
+            'max_rss_growth_mb': max(growth) / (1024 * 1024) if growth else None,
+        }
+    return summary
+
+
+def print_summary(summary, wall_time, total, peak_rss_bytes=None):
+    print(f"\n{total} requests in {wall_time:.2f}s ({total / wall_time if wall_time else 0:.1f} req/s)")
+    header = f"{'endpoint':<14}{'reqs':>6}{'req/s':>8}{'err%':>7}{'app%':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'cpu ms':>9}{'+rss MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for endpoint, s in summary.items():
+        growth = s['max_rss_growth_mb']
+        print(
+            f"{endpoint:<14}{s['requests']:>6}{s['throughput_rps']:>8.1f}"
+            f"{s['error_rate'] * 100:>7.1f}{s['app_error_rate'] * 100:>7.1f}"
+            f"{s['p50_ms']:>9.1f}{s['p90_ms']:>9.1f}{s['p99_ms']:>9.1f}"
+            f"{s['cpu_ms_per_request']:>9.1f}{'-' if growth is None else f'{growth:.1f}':>9}"
+        )
+    print("(+rss MB: largest memory growth caused by one request, measured with --concurrency 1 only)")
+    if peak_rss_bytes:
+        print(f"Serving process peak RSS: {peak_rss_bytes / (1024 * 1024):.0f} MB (whole run, all endpoints)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('traffic', nargs='?', help='JSON-lines traffic file to replay')
+    parser.add_argument('--synthetic', type=int, metavar='N', help='generate N requests instead of (or when the file has none)')
+    parser.add_argument('--concurrency', type=int, default=4, help='simultaneous clients (default: 4)')
+    parser.add_argument('--rate', type=float, help='open-loop arrival rate in requests/second')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the traffic this many times')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--url', help='send HTTP requests to this running server')
+    group.add_argument('--serve', choices=sorted(SERVE_COMMANDS), help='start a local server with this worker model')
+    parser.add_argument('--label', help='name for this run in the JSON summary')
+    parser.add_argument('--json', metavar='PATH', help='append a JSON summary line to this file')
+    args = parser.parse_args()
+
+    specs = read_traffic(args.traffic) if args.traffic else []
+    if args.synthetic or not specs:
+        specs = synthetic_traffic(args.synthetic or 100)
+    specs = specs * args.repeat
+
+    server = None
+    if args.serve:
+        server, url = start_server(args.serve)
+        transport = HttpTransport(url, pid=server.pid)
+        mode = args.serve
+    elif args.url:
+        transport = HttpTransport(args.url)
+        mode = 'http'
+    else:
+        transport = InProcessTransport()
+        mode = 'inprocess'
+
+    try:
+        records, wall_time = run(transport, specs, args.concurrency, args.rate)
+        peak = process_peak_rss(transport)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(records, wall_time)
+    print_summary(summary, wall_time, len(records), peak)
+    if args.concurrency > 1 and isinstance(transport, HttpTransport):
+        print("(server CPU/RSS per endpoint is only attributed with --concurrency 1; "
+              "the figures above are client-side)")
+
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps({
+                'label': args.label or mode,
+                'mode': mode,
+                'concurrency': args.concurrency,
+                'rate': args.rate,
+                'requests': len(records),
+                'wall_time_s': wall_time,
+                'peak_rss_mb': peak / (1024 * 1024) if peak else None,
+                'endpoints': summary,
+            }) + '\n')
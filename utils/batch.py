@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Batch matching of many queries against the song catalog.
+
+Queries are dicts holding one of ``features`` (already-extracted features),
+``audio_path`` (a file on disk) or ``audio`` (raw bytes), plus an optional
+``id`` echoed back in the result. Queries are ranked with the same staged
+matcher as the live endpoints, without a time budget, so re-scoring past
+queries gives the results a live query would get with its full budget.
+"""
+
+import functools
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.qtune_processor import QTuneProcessor, prepare_intervals
+
+# Per-process state, filled in by _init_worker
+_processor = None
+_options = None
+
+
+def _init_worker(options):
+    global _processor, _options
+    _processor = QTuneProcessor()
+    _options = dict(options, prepared=prepare_intervals(options['database']))
+
+
+def _score_in_worker(item, top_n):
+    return _score_query(item, _processor, top_n=top_n, **_options)
+
+
+def _score_query(item, processor, database, top_n, index=None, candidates=50,
+                 max_duration=None, prepared=None):
+    position, query = item
+    result = {'index': position}
+    if 'id' in query:
+        result['id'] = query['id']
+
+    try:
+        if 'features' in query:
+            features = query['features'] or {}
+        elif 'audio_path' in query:
+            features = processor.process_audio_file(query['audio_path'])
+        elif 'audio' in query:
+            features = processor.process_user_audio(query['audio'], max_duration=max_duration)
+        else:
+            result.update({'success': False, 'error': 'Query has no features, audio_path or audio'})
+            return result
+
+        if not features:
+            result.update({'success': False, 'error': 'Could not extract features from audio.'})
+            return result
+
+        result.update({
+            'success': True,
+            'features': {
+                'tempo': features.get('tempo', 0),
+                'duration': features.get('duration', 0),
+                'pitch_count': features.get('pitch_count', 0),
+                'onset_count': features.get('onset_count', 0)
+            },
+            'matches': processor.find_best_matches(
+                features, database, top_n=top_n, index=index, candidates=candidates,
+                prepared=prepared
+            )
+        })
+    except Exception as e:
+        result.update({'success': False, 'error': str(e)})
+    return result
+
+
+class WorkerPool:
+    """Worker processes kept across batches for as long as the catalog is unchanged.
+
+    Each worker loads the catalog (and its interval arrays) once, when it
+    starts. Concurrent batches share the same workers, so a server never runs
+    more than ``workers`` scoring processes however many batches arrive.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._executor = None
+        self._options = None
+
+    def _same_options(self, options):
+        current = self._options
+        return current is not None and all(
+            current[key] is options[key] if key in ('database', 'index') else current[key] == options[key]
+            for key in options
+        )
+
+    def executor(self, options):
+        """Return the executor for these worker options, replacing one started for others."""
+        with self._lock:
+            if self._executor is None or not self._same_options(options):
+                if self._executor is not None:
+                    # Batches still using the old workers finish on them
+                    self._executor.shutdown(wait=False)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker, initargs=(options,)
+                )
+                self._options = options
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._executor = None
+            self._options = None
+
+
+def iter_batch_matches(queries, database, top_n=3, workers=None, max_duration=None,
+                       index=None, candidates=50, prepared=None, pool=None):
+    """Yield one result dict per query, in input order, as soon as each is ready.
+
+    ``workers`` is the number of processes to use; ``None`` means one per
+    CPU and ``1`` scores everything in the calling process, using
+    ``prepared`` (prepare_intervals(database)) when given. ``pool`` is a
+    WorkerPool to reuse instead of starting processes for this batch.
+    ``max_duration`` caps how many seconds of each ``audio`` query are
+    decoded. ``index`` and ``candidates`` pre-filter large catalogs exactly
+    as live queries do.
+    """
+    options = {
+        'database': database,
+        'index': index,
+        'candidates': candidates,
+        'max_duration': max_duration
+    }
+    items = list(enumerate(queries))
+    if pool is not None:
+        workers = pool.workers
+    elif workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(items)))
+
+    if workers == 1:
+        processor = QTuneProcessor()
+        if prepared is None:
+            prepared = prepare_intervals(database)
+        for item in items:
+            yield _score_query(item, processor, top_n=top_n, prepared=prepared, **options)
+        return
+
+    score = functools.partial(_score_in_worker, top_n=top_n)
+    chunksize = max(1, len(items) // (workers * 4))
+    if pool is not None:
+        for result in pool.executor(options).map(score, items, chunksize=chunksize):
+            yield result
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(options,)
+    ) as executor:
+        for result in executor.map(score, items, chunksize=chunksize):
+            yield result
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Adaptive per-query matching budget.
+
+Matching-stage latencies are tracked over a sliding window. When their p99
+goes over the target the matching budget is cut multiplicatively; once latency
+is comfortably below target it grows back additively (AIMD). Only the time
+spent matching is recorded: audio decoding and feature extraction do not
+depend on the budget, so including them would let slow decoding drive the
+budget to its minimum without ever bringing latency down. No adjustment is
+made until the window holds ``min_samples`` latencies, since below ~100
+samples the "p99" is just the slowest query (often a cold start).
+"""
+
+import threading
+from collections import deque
+
+
+class AdaptiveBudget:
+    def __init__(self, target_p99, max_budget, min_budget, window=200, adjust_every=20,
+                 min_samples=100):
+        self.target_p99 = target_p99
+        self.max_budget = max_budget
+        self.min_budget = min_budget
+        self.adjust_every = adjust_every
+        self.min_samples = min(min_samples, window)
+        self._budget = max_budget
+        self._latencies = deque(maxlen=window)
+        self._since_adjust = 0
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self):
+        """Matching budget in seconds for the next query."""
+        return self._budget
+
+    def p99(self):
+        with self._lock:
+            ordered = sorted(self._latencies)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+
+    def record(self, latency):
+        """Add one matching latency (seconds) and adjust the budget periodically."""
+        with self._lock:
+            self._latencies.append(latency)
+            self._since_adjust += 1
+            if self._since_adjust < self.adjust_every or len(self._latencies) < self.min_samples:
+                return
+            self._since_adjust = 0
+
+        p99 = self.p99()
+        with self._lock:
+            if p99 > self.target_p99:
+                self._budget = max(self.min_budget, self._budget * 0.7)
+            elif p99 < 0.7 * self.target_p99:
+                step = (self.max_budget - self.min_budget) / 10
+                self._budget = min(self.max_budget, self._budget + step)
+
+    def stats(self):
+        return {
+            'budget_ms': round(self._budget * 1000, 1),
+            'p99_ms': round(self.p99() * 1000, 1),
+            'target_p99_ms': round(self.target_p99 * 1000, 1),
+            'samples': len(self._latencies),
+        }
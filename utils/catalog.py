@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""Song catalog lifecycle manager for HumSearch.
+
+Keeps the song database in memory, reloads it when the JSON file changes on
+disk and rebuilds it in the background (one builder at a time) when the file
+is missing or corrupt, so that no request ever pays for audio ingestion.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from utils.melody_index import MelodyIndex
+from utils.qtune_processor import prepare_intervals
+
+
+class SongIndex:
+    """Name-sorted listing rows derived from one version of the catalog."""
+
+    LISTING_FIELDS = ('name', 'path', 'tempo', 'pitch_count', 'duration', 'onset_count')
+
+    def __init__(self, database):
+        rows = [
+            {
+                'name': song.get('name'),
+                'path': song.get('path'),
+                'tempo': song.get('tempo'),
+                'pitch_count': song.get('pitch_count', 0),
+                'duration': song.get('duration'),
+                'onset_count': song.get('onset_count', 0)
+            }
+            for song in database
+        ]
+        rows.sort(key=lambda row: (row['name'] or '').lower())
+        self.rows = rows
+        self.keys = [(row['name'] or '').lower() for row in rows]
+
+    def search(self, prefix='', offset=0, limit=None):
+        """Return (rows, total) for songs whose name starts with ``prefix``."""
+        prefix = prefix.lower()
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + '\U0010ffff') if prefix else len(self.keys)
+        start = min(hi, lo + offset)
+        end = hi if limit is None else min(hi, start + limit)
+        return self.rows[start:end], hi - lo
+
+
+class SongCatalog:
+    # A rebuild lock file older than this is considered abandoned
+    LOCK_STALE_SECONDS = 30 * 60
+    # After a failed rebuild, background rebuilds are not retried for this long
+    REBUILD_RETRY_SECONDS = 5 * 60
+
+    def __init__(self, db_path, builder, ann_min_songs=None):
+        self.db_path = Path(db_path)
+        self.backup_path = self.db_path.with_name(self.db_path.name + '.bak')
+        self.lock_path = self.db_path.with_name(self.db_path.name + '.lock')
+        self.ann_path = self.db_path.with_name(self.db_path.stem + '.index.npz')
+        self.builder = builder
+        # Catalogs with fewer songs than this are always scanned exactly
+        self.ann_min_songs = ann_min_songs
+
+        self._state_lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._build_done = threading.Event()
+        self._build_done.set()
+        self._build_failed_at = None
+        self._built_elsewhere = False
+
+        self._database = None
+        self._stamp = None
+        self._index = None
+        self._index_version = None
+        self._prepared = None
+        self._prepared_source = None
+        self._ann = None
+        self._ann_version = None
+        self._ann_lock = threading.Lock()
+        self.version = ''
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+    def _file_stamp(self, path):
+        """Return (mtime_ns, size) for a file, or None if it does not exist."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read(self, path):
+        """Read a database file, returning the song list or None if unusable."""
+        try:
+            with open(path, 'r') as f:
+                database = json.load(f)
+        except Exception:
+            return None
+        if not isinstance(database, list):
+            return None
+        return database
+
+    def _set(self, database, stamp):
+        with self._state_lock:
+            self._database = database
+            self._stamp = stamp
+            if stamp:
+                self.version = f"{stamp[0]:x}-{stamp[1]:x}"
+            else:
+                self.version = f"mem-{id(database):x}"
+
+    def get(self):
+        """Return the current song list without ever building it inline.
+
+        Falls back to the in-memory copy, then the last-known-good backup,
+        and schedules a background rebuild when neither the database file
+        nor a previous copy is usable.
+        """
+        stamp = self._file_stamp(self.db_path)
+
+        if stamp is not None and stamp == self._stamp:
+            return self._database
+
+        if stamp is not None:
+            database = self._read(self.db_path)
+            if database is not None:
+                self._set(database, stamp)
+                return database
+
+        # Database file missing or corrupt: serve the stale copy while rebuilding
+        self.rebuild()
+
+        if self._database is not None:
+            return self._database
+
+        backup = self._read(self.backup_path)
+        if backup is not None:
+            print("Song database unavailable, serving last-known-good copy")
+            self._set(backup, self._file_stamp(self.backup_path))
+            return backup
+
+        return []
+
+    def index(self):
+        """Return the SongIndex for the current catalog version, building it once."""
+        database = self.get()
+        with self._state_lock:
+            if self._index is None or self._index_version != self.version:
+                self._index = SongIndex(database)
+                self._index_version = self.version
+            return self._index
+
+    def prepared(self, database=None):
+        """Return prepare_intervals() of ``database`` (default: the current catalog), computed once."""
+        if database is None:
+            database = self.get()
+        with self._state_lock:
+            if self._prepared_source is not database:
+                self._prepared = prepare_intervals(database)
+                self._prepared_source = database
+            return self._prepared
+
+    def _build_melody_index(self, database, version):
+        try:
+            ann = MelodyIndex.load(self.ann_path, version)
+            if ann is None:
+                print(f"Building melody index for {len(database)} songs...")
+                ann = MelodyIndex.build(database)
+                ann.save(self.ann_path, version)
+            if self.version == version:
+                self._ann = ann
+        except Exception as e:
+            print(f"Error building melody index: {e}")
+        finally:
+            self._ann_lock.release()
+
+    def melody_index(self, wait=False):
+        """Return the ANN index for the current catalog version.
+
+        Returns None when the catalog is small enough for an exact scan, or
+        while the index is still being built in the background.
+        """
+        database = self.get()
+        if self.ann_min_songs is None or len(database) < self.ann_min_songs:
+            return None
+
+        version = self.version
+        ann = self._ann
+        if ann is not None and ann.song_count == len(database) and self._ann_version == version:
+            return ann
+
+        if self._ann_lock.acquire(blocking=False):
+            self._ann = None
+            self._ann_version = version
+            if wait:
+                self._build_melody_index(database, version)
+            else:
+                threading.Thread(
+                    target=self._build_melody_index, args=(database, version),
+                    name='melody-index-build', daemon=True
+                ).start()
+        elif wait:
+            with self._ann_lock:
+                pass
+        return self._ann if wait else None
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+    def save(self, database):
+        """Atomically write the database, keeping the previous file as backup."""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=self.db_path.name + '.', suffix='.tmp', dir=self.db_path.parent
+        )
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(database, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self._read(self.db_path) is not None:
+                os.replace(self.db_path, self.backup_path)
+            os.replace(tmp_path, self.db_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        self._set(database, self._file_stamp(self.db_path))
+
+    # ------------------------------------------------------------------
+    # Rebuilding
+    # ------------------------------------------------------------------
+    def _locked_elsewhere(self):
+        """True while a fresh rebuild lock file exists, i.e. a build is already running."""
+        stamp = self._file_stamp(self.lock_path)
+        return stamp is not None and time.time() - stamp[0] / 1e9 <= self.LOCK_STALE_SECONDS
+
+    def _acquire_file_lock(self):
+        """Take the cross-process rebuild lock; return False if another process holds it."""
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._locked_elsewhere():
+                try:
+                    os.unlink(self.lock_path)
+                except OSError:
+                    pass
+                return self._acquire_file_lock()
+            return False
+        except OSError:
+            # Read-only directory etc.: fall back to in-process locking only
+            return True
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def _release_file_lock(self):
+        try:
+            os.unlink(self.lock_path)
+        except OSError:
+            pass
+
+    def _run_build(self):
+        try:
+            self._built_elsewhere = False
+            if not self._acquire_file_lock():
+                print("Song database rebuild already running in another process")
+                self._built_elsewhere = True
+                return
+            try:
+                database = self.builder()
+                self.save(database)
+                self._build_failed_at = None
+                print(f"Database created with {len(database)} songs")
+            finally:
+                self._release_file_lock()
+        except Exception as e:
+            self._build_failed_at = time.time()
+            print(f"Error rebuilding song database: {e}")
+        finally:
+            self._build_done.set()
+            self._build_lock.release()
+
+    def rebuild(self, wait=False):
+        """Start a single-flight rebuild; concurrent callers join the running one.
+
+        Returns the current song list once the build finishes when ``wait`` is
+        true, otherwise returns immediately. A background rebuild is not
+        started while another process holds the rebuild lock (its result is
+        picked up by get() once the new file appears), nor within
+        REBUILD_RETRY_SECONDS of a failed one. Waiting callers wait for a
+        build running in another process and return its result.
+        """
+        if not wait:
+            if self._locked_elsewhere():
+                return None
+            failed_at = self._build_failed_at
+            if failed_at is not None and time.time() - failed_at < self.REBUILD_RETRY_SECONDS:
+                return None
+
+        if self._build_lock.acquire(blocking=False):
+            self._build_done.clear()
+            if wait:
+                self._run_build()
+            else:
+                threading.Thread(
+                    target=self._run_build, name='song-catalog-rebuild', daemon=True
+                ).start()
+
+        if wait:
+            self._build_done.wait()
+            if self._built_elsewhere:
+                self._wait_for_remote_build()
+            return self._database if self._database is not None else []
+        return None
+
+    def _wait_for_remote_build(self):
+        print("Waiting for the other process to finish building the song database...")
+        while self._locked_elsewhere():
+            time.sleep(1)
+        stamp = self._file_stamp(self.db_path)
+        database = self._read(self.db_path) if stamp is not None else None
+        if database is not None:
+            self._set(database, stamp)
+
+    @property
+    def building(self):
+        return not self._build_done.is_set()
+
+    def warm_up(self):
+        """Load the catalog at server start, building it synchronously if needed."""
+        stamp = self._file_stamp(self.db_path)
+        database = self._read(self.db_path) if stamp is not None else None
+        if database is None:
+            print("Song database missing or corrupt, building it before serving requests...")
+            database = self.rebuild(wait=True)
+        else:
+            self._set(database, stamp)
+
+        self.prepared(database)
+        self.melody_index(wait=True)
+        return database
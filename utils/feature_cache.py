@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed on-disk store for QTune feature-extraction artifacts.
+
+Artifacts are keyed by the SHA-256 of the source audio plus a fingerprint of
+the processor parameters that produced them, so unchanged songs are never
+re-decoded or re-analysed when the database is regenerated. Reads and
+touch() refresh an entry's mtime, so prune() can drop entries that a full
+rebuild no longer uses (removed songs, superseded fingerprints) and evict
+the least recently used ones beyond a size cap.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifact_key(content_hash, fingerprint):
+    """Combine a content hash and a parameter fingerprint into a cache key."""
+    payload = json.dumps([content_hash, fingerprint], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, stage, key):
+        return self.root / stage / key[:2] / f"{key}.npz"
+
+    def get(self, stage, key):
+        """Return the stored arrays for a stage as a dict, or None on a miss."""
+        path = self._path(stage, key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entry = {name: data[name] for name in data.files}
+            self._touch_path(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Discarding unreadable cache entry {path.name}: {e}")
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+
+    def _touch_path(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def touch(self, stage, key):
+        """Mark an entry as still in use without reading it."""
+        self._touch_path(self._path(stage, key))
+
+    def prune(self, unused_since=None, max_bytes=None):
+        """Delete entries not used since ``unused_since`` (a timestamp), then
+        least recently used ones until the cache fits in ``max_bytes``.
+
+        Returns the number of entries removed.
+        """
+        entries = []
+        for path in self.root.glob('*/*/*.npz'):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        removed = 0
+        kept = []
+        for mtime, size, path in entries:
+            if unused_since is not None and mtime < unused_since:
+                try:
+                    path.unlink()
+                    removed += 1
+                except OSError:
+                    pass
+            else:
+                kept.append((mtime, size, path))
+
+        if max_bytes is not None:
+            total = sum(size for _, size, _ in kept)
+            for mtime, size, path in kept:
+                if total <= max_bytes:
+                    break
+                try:
+                    path.unlink()
+                    removed += 1
+                    total -= size
+                except OSError:
+                    pass
+        return removed
+
+    def put(self, stage, key, **arrays):
+        """Atomically store named arrays for a stage."""
+        path = self._path(stage, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{name: np.asarray(value) for name, value in arrays.items()})
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
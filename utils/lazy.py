@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Deferred imports for heavy optional modules, with per-module import timing.
+
+``lazy_import('librosa')`` returns a stand-in that imports the real module the
+first time one of its attributes is used, so processes that never touch the
+audio stack (e.g. workers only serving get_songs/play_song) never pay for it.
+"""
+
+import importlib
+import importlib.util
+import sys
+import time
+
+# Seconds spent importing each module through this helper, in load order
+import_times = {}
+
+
+def timed_import(name):
+    """Import a module now and record how long it took."""
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times.setdefault(name, time.perf_counter() - start)
+    return module
+
+
+def is_available(name):
+    """Check whether a module can be imported, without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = timed_import(self._name)
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        module = self._load()
+        # Packages such as librosa load submodules lazily themselves, so time
+        # the first lookup of each attribute too when it imports anything
+        before = len(sys.modules)
+        start = time.perf_counter()
+        value = getattr(module, attr)
+        if len(sys.modules) > before:
+            import_times.setdefault(f"{self._name}.{attr}", time.perf_counter() - start)
+        # Cache on the instance so later lookups skip __getattr__
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def report_import_times():
+    """Print how long each deferred module took to import."""
+    for name, seconds in import_times.items():
+        print(f"  import {name}: {seconds * 1000:.0f} ms")
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Approximate nearest-neighbour index over fixed-length melody embeddings.
+
+Each song's relative-pitch sequence is cut into overlapping windows and every
+window is embedded as an interval histogram plus a downsampled pitch contour
+and the song tempo. The embeddings go into an inverted-file (IVF) index built
+with NumPy k-means, so a query only scans the few clusters nearest to each of
+its windows and exact scoring only runs on the songs those windows hit.
+Queries too short to contain a full window aligned with a song window get no
+candidates (None), and callers scan the catalog exactly instead.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+WINDOW = 16          # intervals per window
+HOP = 4              # stride between song windows
+HIST_RANGE = 12      # intervals are clipped to [-12, 12] semitones for the histogram
+CONTOUR_POINTS = 8   # samples of the cumulative pitch contour per window
+TEMPO_WEIGHT = 0.5
+
+EMBEDDING_DIM = (2 * HIST_RANGE + 1) + CONTOUR_POINTS + 1
+
+# Shortest query guaranteed to contain a window that lines up with a song window
+MIN_QUERY_INTERVALS = WINDOW + HOP - 1
+# Query windows searched per query (spread over the whole query)
+MAX_QUERY_WINDOWS = 2 * HOP
+
+
+def embed_windows(pitches, tempo, hop=HOP) -> np.ndarray:
+    """Embed the sliding windows of one interval sequence as unit float32 vectors."""
+    values = np.asarray(pitches, dtype=np.float64)
+    if len(values) == 0:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+
+    if len(values) <= WINDOW:
+        windows = values[None, :]
+    else:
+        windows = np.lib.stride_tricks.sliding_window_view(values, WINDOW)[::hop]
+    n, length = windows.shape
+
+    # Interval histogram, as a fraction of the window
+    bins = np.clip(np.rint(windows), -HIST_RANGE, HIST_RANGE).astype(np.int64) + HIST_RANGE
+    hist = np.zeros((n, 2 * HIST_RANGE + 1))
+    np.add.at(hist, (np.repeat(np.arange(n), length), bins.ravel()), 1.0)
+    hist /= length
+
+    # Mean-centred, unit-norm contour (cumulative pitch) at fixed sample points
+    contour = np.cumsum(windows, axis=1)
+    positions = np.linspace(0, length - 1, CONTOUR_POINTS).round().astype(np.int64)
+    contour = contour[:, positions]
+    contour -= contour.mean(axis=1, keepdims=True)
+    contour /= np.linalg.norm(contour, axis=1, keepdims=True) + 1e-9
+
+    tempo_feature = np.full((n, 1), TEMPO_WEIGHT * np.clip(np.log2(max(tempo or 120, 1) / 120), -1, 1))
+
+    vectors = np.hstack([hist, contour, tempo_feature])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+    return vectors.astype(np.float32)
+
+
+def _kmeans(vectors, n_lists, iterations=10, sample_size=50000, seed=0):
+    """Spherical k-means on a sample of the vectors; returns unit centroids."""
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    if len(vectors) > sample_size:
+        sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=n_lists)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = sums / (np.linalg.norm(sums, axis=1, keepdims=True) + 1e-9)
+    return centroids.astype(np.float32)
+
+
+def _assign(vectors, centroids, block=65536):
+    return np.concatenate([
+        np.argmax(vectors[i:i + block] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), block)
+    ]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+class MelodyIndex:
+    def __init__(self, centroids, offsets, vectors, song_ids, song_count):
+        self.centroids = centroids
+        self.offsets = offsets      # vectors of list i are vectors[offsets[i]:offsets[i + 1]]
+        self.vectors = vectors
+        self.song_ids = song_ids
+        self.song_count = song_count
+        self._bounds = [int(o) for o in offsets]
+
+    @classmethod
+    def build(cls, database, n_lists=None):
+        """Embed every song window and cluster them into an IVF index."""
+        parts, ids = [], []
+        for i, song in enumerate(database):
+            vectors = embed_windows(song.get('relative_pitches', []), song.get('tempo', 120))
+            parts.append(vectors)
+            ids.append(np.full(len(vectors), i, dtype=np.int32))
+        vectors = np.concatenate(parts) if parts else np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        song_ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        if len(vectors):
+            centroids = _kmeans(vectors, n_lists)
+        else:
+            centroids = np.zeros((1, EMBEDDING_DIM), dtype=np.float32)
+        assign = _assign(vectors, centroids)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=len(centroids)))))
+
+        return cls(centroids, offsets, vectors[order], song_ids[order], len(database))
+
+    def search(self, query_vectors, n_probe=4):
+        """Return (song_ids, scores) of every song hit, best first.
+
+        Each query vector is compared with the vectors of its ``n_probe``
+        nearest lists (contiguous slices, so no gathering); a song's score is
+        its best window score against any query vector.
+        """
+        n_probe = min(n_probe, len(self.centroids))
+        if len(query_vectors) == 0 or len(self.vectors) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+
+        probes = np.argpartition(-(query_vectors @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        bounds = self._bounds
+        scores, ids = [], []
+        for q, lists in zip(query_vectors, probes.tolist()):
+            for l in lists:
+                start, end = bounds[l], bounds[l + 1]
+                if end > start:
+                    scores.append(self.vectors[start:end] @ q)
+                    ids.append(self.song_ids[start:end])
+        if not scores:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+
+        best = np.full(self.song_count, -np.inf, dtype=np.float32)
+        np.maximum.at(best, np.concatenate(ids), np.concatenate(scores))
+        hit = np.flatnonzero(best > -np.inf)
+        hit = hit[np.argsort(-best[hit], kind='stable')]
+        return hit.astype(np.int32), best[hit]
+
+    def candidates(self, user_features, limit=50, n_probe=4):
+        """Positions of the songs whose windows best match the query's windows.
+
+        Returns None for queries shorter than MIN_QUERY_INTERVALS, which the
+        index cannot answer reliably; the caller should scan every song.
+        """
+        pitches = user_features.get('relative_pitches', [])
+        if len(pitches) < MIN_QUERY_INTERVALS:
+            return None
+        queries = embed_windows(pitches, user_features.get('tempo', 120), hop=1)
+        # Evenly spread windows still cover every alignment with the song windows
+        if len(queries) > MAX_QUERY_WINDOWS:
+            queries = queries[np.linspace(0, len(queries) - 1, MAX_QUERY_WINDOWS).round().astype(np.int64)]
+        song_ids, _ = self.search(queries, n_probe=n_probe)
+        return song_ids[:limit].tolist()
+
+    def save(self, path, version):
+        """Atomically write the index, tagged with the catalog version it was built from."""
+        path = str(path)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, version=np.array(version), centroids=self.centroids,
+                         offsets=self.offsets, vectors=self.vectors,
+                         song_ids=self.song_ids, song_count=np.array(self.song_count))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, version):
+        """Load a saved index, or return None if missing or built from another version."""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['version']) != version:
+                    return None
+                return cls(data['centroids'], data['offsets'], data['vectors'],
+                           data['song_ids'], int(data['song_count']))
+        except (OSError, KeyError, ValueError):
+            return None
@@ -2,24 +2,277 @@
 """QTune Processor for HumSearch (Librosa Version)"""
 
 import numpy as np
-import librosa
-import librosa.display
-import soundfile as sf
-import json
 import os
 import tempfile
-from scipy import signal
-from scipy.ndimage import maximum_filter
-from scipy.signal import find_peaks
+import time
 from math import log2
-from django.conf import settings
+from utils.feature_cache import artifact_key, file_hash
+from utils.lazy import is_available, lazy_import
 
-class QTuneProcessor:
+# Audio analysis and the optional JIT backend are only imported on first use
+librosa = lazy_import('librosa')
+numba = lazy_import('numba')
+
+def as_intervals(pitches) -> np.ndarray:
+    """Convert a relative-pitch sequence to the int8 array the scorer kernels expect."""
+    values = np.asarray(pitches, dtype=np.float64)
+    return np.clip(np.rint(values), -127, 127).astype(np.int8)
+
+
+def prepare_intervals(database) -> list:
+    """Interval arrays of every song, in database order, for find_best_matches(prepared=...)."""
+    return [as_intervals(song.get('relative_pitches', [])) for song in database]
+
+
+class NumpyScorer:
+    """Reference scoring kernels over int8 interval sequences (pure NumPy)."""
+    
+    name = 'numpy'
+    
+    def correlation(self, a: np.ndarray, b: np.ndarray) -> float:
+        """Pearson correlation of the common prefix; NaN if either side is constant."""
+        n = min(len(a), len(b))
+        if n == 0:
+            return float('nan')
+        x = a[:n].astype(np.float64)
+        y = b[:n].astype(np.float64)
+        x -= x.mean()
+        y -= y.mean()
+        denom = np.sqrt(np.dot(x, x) * np.dot(y, y))
+        if denom == 0:
+            return float('nan')
+        return float(np.dot(x, y) / denom)
+    
+    def dtw(self, a: np.ndarray, b: np.ndarray, band: int = 10, open_end: bool = False) -> float:
+        """Banded DTW distance (sum of |a_i - b_j| on the path), normalised by n + m.
+        
+        With ``open_end`` the path may stop at any reachable b_j once all of
+        ``a`` is consumed (subsequence alignment of ``a`` against a prefix of
+        ``b``); the best such end, normalised by n + j, is returned.
+        """
+        n, m = len(a), len(b)
+        if n == 0 or m == 0:
+            return float('inf')
+        band = max(band, abs(n - m))
+        x = a.astype(np.int32)
+        y = b.astype(np.int32)
+        prev = np.full(m + 1, np.inf)
+        prev[0] = 0.0
+        for i in range(1, n + 1):
+            curr = np.full(m + 1, np.inf)
+            lo = max(1, i - band)
+            hi = min(m, i + band)
+            cost = np.abs(x[i - 1] - y[lo - 1:hi])
+            # Diagonal and vertical moves vectorise; the horizontal move is a running scan
+            diag_up = np.minimum(prev[lo - 1:hi], prev[lo:hi + 1]) + cost
+            left = curr[lo - 1]
+            for k in range(len(diag_up)):
+                left = min(diag_up[k], left + cost[k])
+                curr[lo + k] = left
+            prev = curr
+        if open_end:
+            lo = max(1, n - band)
+            return float(np.min(prev[lo:] / (n + np.arange(lo, m + 1))))
+        return float(prev[m] / (n + m))
+    
+    def edit_distance(self, a: np.ndarray, b: np.ndarray) -> int:
+        """Levenshtein distance between two interval sequences."""
+        n, m = len(a), len(b)
+        if n == 0 or m == 0:
+            return max(n, m)
+        steps = np.arange(m + 1)
+        prev = steps.copy()
+        for i in range(1, n + 1):
+            substitute = prev[:-1] + (a[i - 1] != b)
+            delete = prev[1:] + 1
+            tmp = np.empty(m + 1, dtype=np.int64)
+            tmp[0] = i
+            tmp[1:] = np.minimum(substitute, delete)
+            # Insertions: D[j] = min_k(tmp[k] + j - k), a running minimum
+            prev = np.minimum.accumulate(tmp - steps) + steps
+        return int(prev[m])
+
+
+def _build_numba_kernels():
+    """Compile (lazily, on first call) the nogil kernels used by NumbaScorer."""
+    jit = numba.njit(nogil=True, cache=True)
+    
+    @jit
+    def correlation(a, b):
+        n = min(a.shape[0], b.shape[0])
+        if n == 0:
+            return np.nan
+        sx = 0.0
+        sy = 0.0
+        for i in range(n):
+            sx += a[i]
+            sy += b[i]
+        mx = sx / n
+        my = sy / n
+        sxy = 0.0
+        sxx = 0.0
+        syy = 0.0
+        for i in range(n):
+            dx = a[i] - mx
+            dy = b[i] - my
+            sxy += dx * dy
+            sxx += dx * dx
+            syy += dy * dy
+        if sxx == 0.0 or syy == 0.0:
+            return np.nan
+        return sxy / np.sqrt(sxx * syy)
+    
+    @jit
+    def dtw(a, b, band, open_end):
+        n = a.shape[0]
+        m = b.shape[0]
+        if n == 0 or m == 0:
+            return np.inf
+        band = max(band, abs(n - m))
+        prev = np.full(m + 1, np.inf)
+        curr = np.full(m + 1, np.inf)
+        prev[0] = 0.0
+        for i in range(1, n + 1):
+            curr[:] = np.inf
+            lo = max(1, i - band)
+            hi = min(m, i + band)
+            for j in range(lo, hi + 1):
+                cost = abs(np.int32(a[i - 1]) - np.int32(b[j - 1]))
+                best = prev[j - 1]
+                if prev[j] < best:
+                    best = prev[j]
+                if curr[j - 1] < best:
+                    best = curr[j - 1]
+                curr[j] = cost + best
+            prev, curr = curr, prev
+        if open_end:
+            best = np.inf
+            for j in range(max(1, n - band), m + 1):
+                if prev[j] / (n + j) < best:
+                    best = prev[j] / (n + j)
+            return best
+        return prev[m] / (n + m)
+    
+    @jit
+    def edit_distance(a, b):
+        n = a.shape[0]
+        m = b.shape[0]
+        if n == 0 or m == 0:
+            return max(n, m)
+        prev = np.arange(m + 1)
+        curr = np.empty(m + 1, dtype=prev.dtype)
+        for i in range(1, n + 1):
+            curr[0] = i
+            for j in range(1, m + 1):
+                best = prev[j - 1] + (1 if a[i - 1] != b[j - 1] else 0)
+                if prev[j] + 1 < best:
+                    best = prev[j] + 1
+                if curr[j - 1] + 1 < best:
+                    best = curr[j - 1] + 1
+                curr[j] = best
+            prev, curr = curr, prev
+        return prev[m]
+    
+    return correlation, dtw, edit_distance
+
+
+class NumbaScorer(NumpyScorer):
+    """JIT-compiled (nogil) versions of the NumpyScorer kernels."""
+    
+    name = 'numba'
+    _kernels = None
+    
     def __init__(self):
+        if not is_available('numba'):
+            raise ImportError("numba is not installed")
+    
+    @classmethod
+    def kernels(cls):
+        # Importing numba and defining the kernels is deferred to the first score
+        if cls._kernels is None:
+            cls._kernels = _build_numba_kernels()
+        return cls._kernels
+    
+    def correlation(self, a, b):
+        return float(self.kernels()[0](a, b))
+    
+    def dtw(self, a, b, band=10, open_end=False):
+        return float(self.kernels()[1](a, b, band, open_end))
+    
+    def edit_distance(self, a, b):
+        return int(self.kernels()[2](a, b))
+
+
+SCORER_BACKENDS = {'numpy': NumpyScorer, 'numba': NumbaScorer}
+
+
+def compare_scorers(reference, candidate, trials: int = 300, seed: int = 0) -> list:
+    """Run both backends on random interval sequences; return the cases where they disagree.
+    
+    Covers correlation, DTW (closed and open-ended) and edit distance. Each
+    mismatch is reported as ``(kernel, a, b, reference_value, candidate_value)``.
+    """
+    rng = np.random.default_rng(seed)
+    mismatches = []
+    for _ in range(trials):
+        n = int(rng.integers(1, 40))
+        a = as_intervals(rng.integers(-12, 13, n))
+        b = as_intervals(rng.integers(-12, 13, n + int(rng.integers(0, 15))))
+        band = int(rng.integers(1, 12))
+        checks = [
+            ('correlation', reference.correlation(a, b), candidate.correlation(a, b)),
+            ('dtw', reference.dtw(a, b, band), candidate.dtw(a, b, band)),
+            ('dtw_open_end', reference.dtw(a, b, band, open_end=True), candidate.dtw(a, b, band, open_end=True)),
+            ('edit_distance', reference.edit_distance(a, b), candidate.edit_distance(a, b)),
+        ]
+        for kernel, expected, actual in checks:
+            if not np.isclose(expected, actual, equal_nan=True):
+                mismatches.append((kernel, a.tolist(), b.tolist(), expected, actual))
+    return mismatches
+
+
+def get_scorer(name: str = 'auto'):
+    """Return a scorer backend by name; 'auto' picks numba when it is installed."""
+    if name == 'auto':
+        name = 'numba' if is_available('numba') else 'numpy'
+    return SCORER_BACKENDS[name]()
+
+
+class QTuneProcessor:
+    # Bump a stage's version whenever its output changes, to invalidate cached artifacts
+    STAGE_VERSIONS = {'decode': 2, 'tempo': 1, 'pitch': 1, 'onsets': 1, 'features': 1}
+    STAGE_DEPENDENCIES = {
+        'decode': (),
+        'tempo': ('decode',),
+        'pitch': ('decode',),
+        'onsets': ('decode',),
+        'features': ('tempo', 'pitch', 'onsets'),
+    }
+    
+    def __init__(self, scorer='auto'):
         self.sample_rate = 22050  # Lower sample rate for faster processing
         self.hop_length = 512
         self.n_fft = 2048
+        self.scorer = get_scorer(scorer) if isinstance(scorer, str) else scorer
+        
+    def warm_up(self):
+        """Import the audio stack and compile JIT code ahead of the first request.
         
+        Meant for a pre-fork master (e.g. gunicorn --preload) so that workers
+        inherit loaded modules and populated librosa/numba caches.
+        """
+        t = np.arange(self.sample_rate) / self.sample_rate
+        tone = (0.5 * np.sin(2 * np.pi * 220 * t * (1 + t))).astype(np.float32)
+        self.extract_features(tone)
+        self.warm_up_scorer()
+    
+    def warm_up_scorer(self):
+        """Load or compile the scorer kernels so the first query does not pay for it."""
+        sample = as_intervals([2, -1, 3, -2, 1])
+        self.scorer.correlation(sample, sample)
+        self.scorer.dtw(sample, sample)
+        self.scorer.edit_distance(sample, sample)
+    
     def load_audio(self, audio_path):
         """Load audio file using librosa."""
         try:
@@ -29,33 +282,39 @@ class QTuneProcessor:
             print(f"Error loading audio: {e}")
             return None, None
     
-    def load_audio_from_bytes(self, audio_bytes):
-        """Load audio from bytes."""
+    def load_audio_from_bytes(self, audio_bytes, max_duration=None):
+        """Load audio from bytes, decoding at most ``max_duration`` seconds."""
         try:
             # Save to temp file and load
             with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp:
                 tmp.write(audio_bytes)
                 tmp_path = tmp.name
             
-            audio, sr = librosa.load(tmp_path, sr=self.sample_rate, mono=True)
+            audio, sr = librosa.load(tmp_path, sr=self.sample_rate, mono=True, duration=max_duration)
             os.unlink(tmp_path)
             return audio, sr
         except Exception as e:
             print(f"Error loading audio from bytes: {e}")
             return None, None
     
-    def detect_bpm(self, audio):
-        """Detect tempo using librosa."""
+    def detect_bpm(self, audio, strict=False):
+        """Detect tempo using librosa.
+        
+        Falls back to 120 BPM on errors unless ``strict`` is set, in which
+        case the error is raised.
+        """
         try:
             # Use onset detection for tempo
             onset_env = librosa.onset.onset_strength(y=audio, sr=self.sample_rate)
             tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=self.sample_rate)
             return float(tempo[0]) if len(tempo) > 0 else 120.0
-        except:
+        except Exception:
+            if strict:
+                raise
             return 120.0
     
-    def extract_pitches(self, audio):
-        """Extract pitch using librosa's piptrack."""
+    def extract_pitches(self, audio, strict=False):
+        """Extract pitch using librosa's piptrack (dummy track on errors unless ``strict``)."""
         try:
             # Extract pitch using CQT (Constant-Q Transform)
             cqt = np.abs(librosa.cqt(audio, sr=self.sample_rate, hop_length=self.hop_length))
@@ -91,15 +350,20 @@ class QTuneProcessor:
             
             return pitch_times, np.array(pitch_values), np.array(pitch_confidence)
         except Exception as e:
+            if strict:
+                raise
             print(f"Error extracting pitches: {e}")
-            # Return dummy data
-            dummy_times = np.linspace(0, len(audio)/self.sample_rate, 100)
-            dummy_pitches = np.zeros(100)
-            dummy_confidence = np.zeros(100)
-            return dummy_times, dummy_pitches, dummy_confidence
-    
-    def detect_onsets(self, audio):
-        """Detect onsets using librosa."""
+            return self._fallback_pitches(audio)
+    
+    def _fallback_pitches(self, audio):
+        """Dummy (all-unvoiced) pitch track used when extraction fails."""
+        dummy_times = np.linspace(0, len(audio)/self.sample_rate, 100)
+        dummy_pitches = np.zeros(100)
+        dummy_confidence = np.zeros(100)
+        return dummy_times, dummy_pitches, dummy_confidence
+    
+    def detect_onsets(self, audio, strict=False):
+        """Detect onsets using librosa (evenly spaced onsets on errors unless ``strict``)."""
         try:
             onset_frames = librosa.onset.onset_detect(
                 y=audio, 
@@ -114,10 +378,15 @@ class QTuneProcessor:
             )
             return onset_times
         except Exception as e:
+            if strict:
+                raise
             print(f"Error detecting onsets: {e}")
-            # Return evenly spaced onsets as fallback
-            duration = len(audio) / self.sample_rate
-            return np.linspace(0, duration, min(10, int(duration)))
+            return self._fallback_onsets(audio)
+    
+    def _fallback_onsets(self, audio):
+        """Evenly spaced onsets used when detection fails."""
+        duration = len(audio) / self.sample_rate
+        return np.linspace(0, duration, min(10, int(duration)))
     
     def _get_note_number(self, pitch: float) -> int:
         """Return the number of the note based on its frequency value."""
@@ -193,6 +462,26 @@ class QTuneProcessor:
         
         return result
     
+    def _features_from_tracks(self, num_samples, tempo, pitch_values, onsets):
+        """Turn the tempo, pitch track and onsets into interval features."""
+        # Calculate features
+        num_of_pitches = self._pitches_per_interval(num_samples, pitch_values, onsets)
+        avg_pitches = self._average_per_interval(pitch_values, num_of_pitches, onsets)
+        
+        # Only proceed if we have enough data
+        if len(avg_pitches) > 1:
+            relative_pitches = self._find_relative_pitch(avg_pitches)
+        else:
+            relative_pitches = []
+        
+        return {
+            'tempo': float(tempo),
+            'relative_pitches': relative_pitches,
+            'pitch_count': len(relative_pitches),
+            'duration': num_samples / self.sample_rate,
+            'onset_count': len(onsets)
+        }
+    
     def extract_features(self, audio):
         """Extract all features from audio."""
         try:
@@ -205,30 +494,128 @@ class QTuneProcessor:
             # Detect onsets
             onsets = self.detect_onsets(audio)
             
-            # Calculate features
-            num_of_pitches = self._pitches_per_interval(len(audio), pitch_values, onsets)
-            avg_pitches = self._average_per_interval(pitch_values, num_of_pitches, onsets)
-            
-            # Only proceed if we have enough data
-            if len(avg_pitches) > 1:
-                relative_pitches = self._find_relative_pitch(avg_pitches)
-            else:
-                relative_pitches = []
-            
-            return {
-                'tempo': float(tempo),
-                'relative_pitches': relative_pitches,
-                'pitch_count': len(relative_pitches),
-                'duration': len(audio) / self.sample_rate,
-                'onset_count': len(onsets)
-            }
+            return self._features_from_tracks(len(audio), tempo, pitch_values, onsets)
         except Exception as e:
             print(f"Error extracting features: {e}")
             return None
     
-    def process_audio_file(self, audio_path: str) -> dict:
-        """Process an audio file and extract features."""
+    def fingerprint(self, stage: str) -> dict:
+        """Describe everything that determines a stage's output, including upstream stages."""
+        params = {
+            'decode': {'sample_rate': self.sample_rate},
+            'tempo': {'sample_rate': self.sample_rate},
+            'pitch': {'sample_rate': self.sample_rate, 'hop_length': self.hop_length, 'n_fft': self.n_fft},
+            'onsets': {'sample_rate': self.sample_rate, 'hop_length': self.hop_length},
+            'features': {'sample_rate': self.sample_rate},
+        }[stage]
+        return {
+            'stage': stage,
+            'version': self.STAGE_VERSIONS[stage],
+            'params': params,
+            'upstream': [self.fingerprint(dep) for dep in self.STAGE_DEPENDENCIES[stage]],
+        }
+    
+    def _process_audio_file_cached(self, audio_path: str, cache) -> dict:
+        """Process an audio file, reusing any stage artifacts already in the cache."""
+        content_hash = file_hash(audio_path)
+        keys = {
+            stage: artifact_key(content_hash, self.fingerprint(stage))
+            for stage in self.STAGE_VERSIONS
+        }
+        
+        entry = cache.get('features', keys['features'])
+        if entry is not None:
+            # Keep the upstream artifacts alive too, for when a later stage changes
+            for stage in self.STAGE_DEPENDENCIES:
+                if stage != 'features':
+                    cache.touch(stage, keys[stage])
+            return {
+                'tempo': float(entry['tempo']),
+                'relative_pitches': [int(p) for p in entry['relative_pitches']],
+                'pitch_count': int(entry['pitch_count']),
+                'duration': float(entry['duration']),
+                'onset_count': int(entry['onset_count'])
+            }
+        
+        decoded = {}
+        
+        def get_audio():
+            # Decode lazily: only stages that actually missed need the PCM
+            if 'audio' not in decoded:
+                hit = cache.get('decode', keys['decode'])
+                if hit is not None:
+                    decoded['audio'] = hit['audio'].astype(np.float32) / 32767
+                else:
+                    audio, sr = self.load_audio(audio_path)
+                    if audio is None:
+                        raise ValueError(f"could not decode {audio_path}")
+                    # PCM is stored as int16, half the size of librosa's float32
+                    pcm = np.rint(np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+                    cache.put('decode', keys['decode'], audio=pcm)
+                    decoded['audio'] = pcm.astype(np.float32) / 32767
+            return decoded['audio']
+        
+        fell_back = []
+        
+        def run_stage(stage, compute, fallback):
+            # Fallback values stand in for one failed run only; never cache them
+            entry = cache.get(stage, keys[stage])
+            if entry is not None:
+                return entry
+            audio = get_audio()
+            try:
+                entry = compute(audio)
+            except Exception as e:
+                print(f"Error in {stage} stage for {audio_path}: {e}")
+                fell_back.append(stage)
+                return fallback(audio)
+            cache.put(stage, keys[stage], **entry)
+            return entry
+        
+        tempo_entry = run_stage(
+            'tempo',
+            lambda audio: {'tempo': self.detect_bpm(audio, strict=True)},
+            lambda audio: {'tempo': 120.0}
+        )
+        pitch_entry = run_stage(
+            'pitch',
+            lambda audio: {'pitch_values': self.extract_pitches(audio, strict=True)[1], 'num_samples': len(audio)},
+            lambda audio: {'pitch_values': self._fallback_pitches(audio)[1], 'num_samples': len(audio)}
+        )
+        onsets_entry = run_stage(
+            'onsets',
+            lambda audio: {'onsets': self.detect_onsets(audio, strict=True)},
+            lambda audio: {'onsets': self._fallback_onsets(audio)}
+        )
+        
+        features = self._features_from_tracks(
+            int(pitch_entry['num_samples']),
+            float(tempo_entry['tempo']),
+            np.asarray(pitch_entry['pitch_values']),
+            np.asarray(onsets_entry['onsets'])
+        )
+        if fell_back:
+            return features
+        cache.put(
+            'features', keys['features'],
+            tempo=features['tempo'],
+            relative_pitches=np.asarray(features['relative_pitches'], dtype=np.int64),
+            pitch_count=features['pitch_count'],
+            duration=features['duration'],
+            onset_count=features['onset_count']
+        )
+        return features
+    
+    def process_audio_file(self, audio_path: str, cache=None) -> dict:
+        """Process an audio file and extract features.
+        
+        When a FeatureCache is given, intermediate artifacts are read from and
+        written to it so unchanged songs are not decoded or analysed again.
+        """
         try:
+            if cache is not None:
+                return self._process_audio_file_cached(audio_path, cache)
+            
             audio, sr = self.load_audio(audio_path)
             if audio is None:
                 return None
@@ -238,10 +625,10 @@ class QTuneProcessor:
             print(f"Error processing audio file: {e}")
             return None
     
-    def process_user_audio(self, audio_data: bytes) -> dict:
+    def process_user_audio(self, audio_data: bytes, max_duration=None) -> dict:
         """Process user audio data from upload/recording."""
         try:
-            audio, sr = self.load_audio_from_bytes(audio_data)
+            audio, sr = self.load_audio_from_bytes(audio_data, max_duration=max_duration)
             if audio is None:
                 return None
             
@@ -253,36 +640,26 @@ class QTuneProcessor:
     def calculate_similarity(self, song_features: dict, user_features: dict) -> float:
         """Calculate similarity score between song and user input."""
         try:
-            song_pitches = song_features.get('relative_pitches', [])
-            user_pitches = user_features.get('relative_pitches', [])
-            
-            if not song_pitches or not user_pitches:
+            song_pitches = as_intervals(song_features.get('relative_pitches', []))
+            user_pitches = as_intervals(user_features.get('relative_pitches', []))
+        except Exception as e:
+            print(f"Error calculating similarity: {e}")
+            return 0.0
+        return self._interval_similarity(
+            song_features, song_pitches, user_pitches, user_features.get('tempo', 120)
+        )
+    
+    def _interval_similarity(self, song: dict, song_pitches: np.ndarray,
+                             user_pitches: np.ndarray, user_tempo) -> float:
+        """calculate_similarity on interval arrays that are already converted."""
+        try:
+            if len(song_pitches) == 0 or len(user_pitches) == 0:
                 return 0.0
             
-            # Calculate tempo similarity
-            song_tempo = song_features.get('tempo', 120)
-            user_tempo = user_features.get('tempo', 120)
+            tempo_similarity = self._tempo_similarity(song.get('tempo', 120), user_tempo)
             
-            tempo_diff = abs(song_tempo - user_tempo)
-            tempo_similarity = max(0, 1.0 - tempo_diff / max(song_tempo, user_tempo))
-            
-            # Calculate pitch sequence similarity using dynamic time warping (DTW)
-            if len(song_pitches) > 0 and len(user_pitches) > 0:
-                # Simple correlation-based similarity
-                min_len = min(len(song_pitches), len(user_pitches))
-                song_segment = np.array(song_pitches[:min_len])
-                user_segment = np.array(user_pitches[:min_len])
-                
-                if np.std(song_segment) > 0 and np.std(user_segment) > 0:
-                    pitch_corr = np.corrcoef(song_segment, user_segment)[0, 1]
-                    if np.isnan(pitch_corr):
-                        pitch_similarity = 0
-                    else:
-                        pitch_similarity = max(0, pitch_corr)
-                else:
-                    pitch_similarity = 0.5
-            else:
-                pitch_similarity = 0
+            # Simple correlation-based pitch similarity
+            pitch_similarity = self._correlation_similarity(song_pitches, user_pitches)
             
             # Combine scores (60% pitch similarity, 40% tempo similarity)
             similarity = (0.6 * pitch_similarity + 0.4 * tempo_similarity) * 100
@@ -292,24 +669,135 @@ class QTuneProcessor:
             print(f"Error calculating similarity: {e}")
             return 0.0
     
-    def find_best_matches(self, user_features: dict, database: list, top_n: int = 3) -> list:
-        """Find best matching songs from database."""
-        matches = []
-        
-        for song in database:
-            similarity = self.calculate_similarity(song, user_features)
-            matches.append({
-                'name': song.get('name', 'Unknown'),
-                'path': song.get('path', ''),
-                'similarity': round(similarity, 1),
-                'tempo': song.get('tempo', 0),
-                'pitch_count': song.get('pitch_count', 0)
-            })
+    def _correlation_similarity(self, song_pitches: np.ndarray, user_pitches: np.ndarray) -> float:
+        """Pitch part of calculate_similarity: the correlation, floored at 0."""
+        pitch_corr = self.scorer.correlation(song_pitches, user_pitches)
+        # The kernel returns NaN only when one side is constant
+        if np.isnan(pitch_corr):
+            return 0.5
+        return max(0, pitch_corr)
+    
+    def _tempo_similarity(self, song_tempo, user_tempo) -> float:
+        return max(0, 1.0 - abs(song_tempo - user_tempo) / max(song_tempo, user_tempo))
+    
+    def _screen_similarity(self, song: dict, song_pitches: np.ndarray,
+                           user_pitches: np.ndarray, user_tempo) -> float:
+        """Cheap screen: tempo plus agreement of up/down contour over the common prefix."""
+        try:
+            n = min(len(song_pitches), len(user_pitches))
+            if n == 0:
+                return 0.0
+            contour = float(np.mean(np.sign(song_pitches[:n]) == np.sign(user_pitches[:n])))
+            tempo_similarity = self._tempo_similarity(song.get('tempo', 120), user_tempo)
+            return max(0, min(100, (0.6 * contour + 0.4 * tempo_similarity) * 100))
+        except Exception:
+            return 0.0
+    
+    def _aligned_similarity(self, song: dict, song_pitches: np.ndarray,
+                            user_pitches: np.ndarray, user_tempo, band: int) -> float:
+        """Score with the pitch term averaged between correlation and a banded-DTW alignment.
         
-        # Sort by similarity
-        matches.sort(key=lambda x: x['similarity'], reverse=True)
+        The query is aligned open-ended against the start of the song, so a
+        query that is an exact prefix of the song has distance 0.
+        """
+        if len(song_pitches) == 0 or len(user_pitches) == 0:
+            return 0.0
+        distance = self.scorer.dtw(user_pitches, song_pitches[:len(user_pitches) + band], band, open_end=True)
+        align_similarity = 1.0 / (1.0 + distance)
         
-        return matches[:top_n]
+        tempo_similarity = self._tempo_similarity(song.get('tempo', 120), user_tempo)
+        pitch_similarity = 0.5 * self._correlation_similarity(song_pitches, user_pitches) + 0.5 * align_similarity
+        return max(0, min(100, (0.6 * pitch_similarity + 0.4 * tempo_similarity) * 100))
     
+    def find_best_matches(self, user_features: dict, database: list, top_n: int = 3,
+                          index=None, candidates: int = 50, budget=None, with_info: bool = False,
+                          prepared=None, align_top: int = 20, band: int = 10):
+        """Find best matching songs from database.
+        
+        Songs are ranked in progressively more expensive stages: a
+        tempo/contour screen over every song, correlation scoring in screen
+        order, then DTW alignment of the ``align_top`` best songs. When
+        ``budget`` (seconds) runs out, the last finished ranking is returned.
+        With a MelodyIndex built from this database, only the ``candidates``
+        songs nearest to the query's melody windows are scored.
+        ``prepared`` is prepare_intervals(database), computed once per catalog
+        version by the caller instead of converting every song per query.
+        
+        Returns the matches, or ``(matches, info)`` with ``with_info``, where
+        info names the stage that produced the ranking and whether every
+        stage completed.
+        """
+        start = time.perf_counter()
+        deadline = start + budget if budget is not None else float('inf')
+        
+        def result(matches, stage, complete):
+            if not with_info:
+                return matches
+            return matches, {
+                'stage': stage,
+                'complete': complete,
+                'budget_ms': round(budget * 1000, 1) if budget is not None else None,
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+            }
+        
+        if prepared is None or len(prepared) != len(database):
+            prepared = None
+        
+        positions = None
+        if index is not None and index.song_count == len(database):
+            # None: query too short for the index, scan every song
+            positions = index.candidates(user_features, limit=candidates)
+        if positions is None:
+            positions = range(len(database))
+        
+        def song_intervals(i):
+            if prepared is not None:
+                return prepared[i]
+            return as_intervals(database[i].get('relative_pitches', []))
+        
+        songs = [(database[i], song_intervals(i)) for i in positions]
+        
+        user_pitches = as_intervals(user_features.get('relative_pitches', []))
+        user_tempo = user_features.get('tempo', 120)
+        
+        def ranking(scored):
+            matches = [self._match_entry(entry[0], similarity) for similarity, entry in scored]
+            matches.sort(key=lambda x: x['similarity'], reverse=True)
+            return matches[:top_n]
+        
+        # Stage 1: screen (songs past the deadline are left out)
+        screened = []
+        for i, entry in enumerate(songs):
+            if i >= top_n and time.perf_counter() >= deadline:
+                return result(ranking(screened), 'screen', False)
+            screened.append((self._screen_similarity(*entry, user_pitches, user_tempo), entry))
+        screened.sort(key=lambda item: item[0], reverse=True)
+        
+        if time.perf_counter() >= deadline:
+            return result(ranking(screened), 'screen', False)
+        
+        # Stage 2: correlation, most promising songs first
+        correlated = []
+        for i, (_, entry) in enumerate(screened):
+            if i >= top_n and time.perf_counter() >= deadline:
+                return result(ranking(correlated), 'correlation', False)
+            correlated.append((self._interval_similarity(*entry, user_pitches, user_tempo), entry))
+        correlated.sort(key=lambda item: item[0], reverse=True)
+        
+        # Stage 3: alignment of the leaders; only used if it finishes
+        aligned = []
+        for _, entry in correlated[:align_top]:
+            if time.perf_counter() >= deadline:
+                return result(ranking(correlated), 'correlation', False)
+            aligned.append((self._aligned_similarity(*entry, user_pitches, user_tempo, band), entry))
+        
+        return result(ranking(aligned or correlated), 'alignment', True)
     
-    
\ No newline at end of file
+    def _match_entry(self, song: dict, similarity: float) -> dict:
+        return {
+            'name': song.get('name', 'Unknown'),
+            'path': song.get('path', ''),
+            'similarity': round(similarity, 1),
+            'tempo': song.get('tempo', 0),
+            'pitch_count': song.get('pitch_count', 0)
+        }
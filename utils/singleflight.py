@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Coalescing of concurrent identical requests ("single flight").
+
+The first caller for a key runs the computation; callers arriving while it is
+in flight wait for it and share its result. With a lock directory configured
+the same happens across processes: the leader holds ``<key>.lock`` and
+publishes ``<key>.json``, which waiting processes read instead of recomputing.
+A lock file older than ``wait_timeout`` (e.g. left by a crashed worker) is
+treated as abandoned and taken over.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+def payload_key(*parts):
+    """Hash request payload parts (bytes or str) into a single-flight key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    POLL_SECONDS = 0.05
+
+    def __init__(self, lock_dir=None, wait_timeout=120, result_ttl=60):
+        self.lock_dir = Path(lock_dir) if lock_dir else None
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._last_sweep = 0.0
+        self.stats = {'leaders': 0, 'coalesced': 0, 'coalesced_remote': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def do(self, key, fn):
+        """Return fn(), sharing one execution among concurrent callers with the same key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats['leaders'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, fn)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    # ------------------------------------------------------------------
+    # Cross-process coordination
+    # ------------------------------------------------------------------
+    def _run(self, key, fn):
+        if self.lock_dir is None:
+            return fn()
+
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        lock_path = self.lock_dir / f"{key}.lock"
+        result_path = self.lock_dir / f"{key}.json"
+
+        deadline = time.time() + self.wait_timeout
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                pass
+
+            if self._lock_stale(lock_path):
+                # Abandoned by a leader that died: remove it and try again
+                try:
+                    os.unlink(lock_path)
+                except OSError:
+                    pass
+                continue
+
+            # Another process is computing this key; wait for it to publish
+            while lock_path.exists() and time.time() < deadline and not self._lock_stale(lock_path):
+                time.sleep(self.POLL_SECONDS)
+            if not lock_path.exists():
+                result = self._read_result(result_path)
+                if result is not None:
+                    self._count('coalesced_remote')
+                    return result
+                continue
+            if self._lock_stale(lock_path):
+                continue
+            # The other process looks stuck: compute without the lock
+            return fn()
+
+        os.close(fd)
+        try:
+            result = fn()
+            self._write_result(result_path, result)
+            return result
+        finally:
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+
+    def _lock_stale(self, path):
+        try:
+            return time.time() - path.stat().st_mtime > self.wait_timeout
+        except OSError:
+            return False
+
+    def _read_result(self, path):
+        try:
+            if time.time() - path.stat().st_mtime > self.result_ttl:
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_result(self, path, result):
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.json.tmp', dir=path.parent)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not publish shared result {path.name}: {e}")
+        self._sweep()
+
+    def _sweep(self):
+        """Delete published results past their TTL (at most once per TTL)."""
+        now = time.time()
+        if now - self._last_sweep < self.result_ttl:
+            return
+        self._last_sweep = now
+        for entry in self.lock_dir.glob('*.json'):
+            try:
+                if now - entry.stat().st_mtime > self.result_ttl:
+                    entry.unlink()
+            except OSError:
+                pass
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Upload guards for the audio endpoints.
+
+Enforces size and duration caps while the request body streams in, sniffs the
+audio container from the first bytes so junk is rejected before decoding, and
+prunes old files from the uploads directory.
+"""
+
+import os
+import struct
+import threading
+import time
+
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+# How many leading bytes are needed to identify a container
+SNIFF_BYTES = 4096
+
+
+class UploadRejected(Exception):
+    """Raised when an upload breaks a size, duration or format rule.
+
+    ``status`` is the HTTP status to answer with: 413 for size, 415 for an
+    unrecognised format and 400 for an over-long recording.
+    """
+
+    def __init__(self, reason, status=400):
+        super().__init__(reason)
+        self.status = status
+
+
+def _too_large(max_bytes):
+    return UploadRejected(f'Upload exceeds the {max_bytes // (1024 * 1024)} MB limit.', status=413)
+
+
+def sniff_audio_format(header: bytes):
+    """Return the audio container name for the leading bytes, or None if unknown."""
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return 'wav'
+    if header[:4] == b'OggS':
+        return 'ogg'
+    if header[:4] == b'fLaC':
+        return 'flac'
+    if header[:4] == b'\x1aE\xdf\xa3':
+        return 'webm'
+    if header[4:8] == b'ftyp':
+        return 'm4a'
+    if header[:3] == b'ID3' or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return 'mp3'
+    return None
+
+
+def wav_duration(header: bytes):
+    """Return the duration in seconds declared by a WAV header, or None if not found."""
+    pos = 12
+    byte_rate = None
+    while pos + 8 <= len(header):
+        chunk_id = header[pos:pos + 4]
+        chunk_size = struct.unpack('<I', header[pos + 4:pos + 8])[0]
+        if chunk_id == b'fmt ' and pos + 20 <= len(header):
+            byte_rate = struct.unpack('<I', header[pos + 16:pos + 20])[0]
+        elif chunk_id == b'data':
+            if byte_rate and chunk_size not in (0, 0xFFFFFFFF):
+                return chunk_size / byte_rate
+            return None
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def check_audio_header(header: bytes, max_seconds):
+    """Validate the leading bytes of an audio payload; raise UploadRejected if bad."""
+    audio_format = sniff_audio_format(header)
+    if audio_format is None:
+        raise UploadRejected('Unsupported or unrecognised audio format.', status=415)
+    if audio_format == 'wav' and max_seconds:
+        duration = wav_duration(header)
+        if duration is not None and duration > max_seconds:
+            raise UploadRejected(f'Audio is longer than {max_seconds} seconds.', status=400)
+    return audio_format
+
+
+class AudioUploadHandler(FileUploadHandler):
+    """Pass-through upload handler that stops oversize or non-audio uploads early.
+
+    Install it ahead of Django's default handlers for a single request; when
+    it rejects an upload, the UploadRejected error is stored on
+    ``request.upload_rejection``.
+    """
+
+    def __init__(self, request, max_bytes, max_seconds=None):
+        super().__init__(request)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        request.upload_rejection = None
+
+    def _reject(self, error):
+        self.request.upload_rejection = error
+        # The rest of the body is drained and discarded, never buffered or
+        # stored, so the client still receives the JSON error response.
+        raise StopUpload(connection_reset=False)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length and content_length > self.max_bytes + 64 * 1024:
+            # Skip parsing entirely; the view reports the rejection
+            self.request.upload_rejection = _too_large(self.max_bytes)
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+        self.header = b''
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            self._reject(_too_large(self.max_bytes))
+
+        if len(self.header) < SNIFF_BYTES:
+            self.header += raw_data[:SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= 12:
+                self._check_header()
+        return raw_data
+
+    def _check_header(self):
+        try:
+            check_audio_header(self.header, self.max_seconds)
+        except UploadRejected as e:
+            self._reject(e)
+
+    def file_complete(self, file_size):
+        # Files too short to have been checked while streaming are checked now
+        if len(self.header) < 12:
+            self._check_header()
+        return None
+
+
+def read_limited_body(request, max_bytes, chunk_size=64 * 1024):
+    """Read a raw request body in chunks, rejecting it as soon as it is too large."""
+    content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    if content_length > max_bytes:
+        raise _too_large(max_bytes)
+
+    chunks = []
+    received = 0
+    while True:
+        chunk = request.read(chunk_size)
+        if not chunk:
+            break
+        received += len(chunk)
+        if received > max_bytes:
+            raise _too_large(max_bytes)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def cleanup_uploads(directory, max_age_seconds, max_total_bytes=None):
+    """Delete uploads older than the retention window, then oldest-first over the size cap.
+
+    Returns the number of files removed.
+    """
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+    except FileNotFoundError:
+        return 0
+
+    now = time.time()
+    files = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries))
+    removed = 0
+    kept = []
+    for mtime, size, path in files:
+        if now - mtime > max_age_seconds:
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+        else:
+            kept.append((mtime, size, path))
+
+    if max_total_bytes is not None:
+        total = sum(size for _, size, _ in kept)
+        for mtime, size, path in kept:
+            if total <= max_total_bytes:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+                total -= size
+            except OSError:
+                pass
+
+    return removed
+
+
+_last_cleanup = 0.0
+_cleanup_lock = threading.Lock()
+
+
+def schedule_upload_cleanup(directory, max_age_seconds, max_total_bytes=None, interval=3600):
+    """Run cleanup_uploads in a background thread at most once per ``interval`` seconds."""
+    global _last_cleanup
+    with _cleanup_lock:
+        if time.time() - _last_cleanup < interval:
+            return
+        _last_cleanup = time.time()
+
+    def run():
+        removed = cleanup_uploads(directory, max_age_seconds, max_total_bytes)
+        if removed:
+            print(f"Removed {removed} old uploads from {directory}")
+
+    threading.Thread(target=run, name='upload-cleanup', daemon=True).start()